@@ -1,8 +1,10 @@
 import pandas as pd
-import numpy as np
-from datetime import datetime
 from pathlib import Path
 
+import name_register
+import projection_engine
+import weighting
+
 
 def main():
 
@@ -11,14 +13,12 @@ def main():
     project_all("2021-07-17")
 
 
-def project_all(projection_date_str):
-    project(projection_date_str, BATTING, True)
-    project(projection_date_str, PITCHING, False)
+def project_all(projection_date_str, indexed=False):
+    projection_engine.project_all(projection_date_str, [MODEL], indexed=indexed)
 
 
-def project(projection_date_str, settings, is_batting):
+def finish(pr, lg_avgs, settings, is_batting):
 
-    MAX_DAYS_AGO = 2000
     LG_AVG_PCT = 0.15
     PROJECTED_PA = 650
     PROJECTED_BF = 800
@@ -27,72 +27,6 @@ def project(projection_date_str, settings, is_batting):
     # Compared to the max appearances, what percentage does a player need to get a projection?
     APPEARANCE_THRESHOLD = 0.10
 
-    # MLB's "GameTypes"
-    SPRING_TRAINING = "S"
-    EXHIBITION = "E"
-    # REGULAR_SEASON = "R"
-    # POST_SEASON = "P"
-
-    # MLB's "SportIDs" for various leagues
-    AAA = 11
-    AA = 12
-    HIGH_A = 13
-    LOW_A = 14
-    ROOKIE = 16
-    FALL = 17
-
-    # Load all player stats
-    df = load_gamelogs(is_batting)
-
-    # Calculate days ago
-    projection_date = datetime.strptime(projection_date_str, "%Y-%m-%d")
-    df["date"] = pd.to_datetime(df["date"], infer_datetime_format=True)
-
-    df["days_ago"] = (projection_date - df["date"]).dt.days
-
-    # Remove data before and after the projection window
-    df = df[df["days_ago"] <= MAX_DAYS_AGO]
-    df = df[df["days_ago"] > 0]
-
-    # Weight stats by decay rate
-    for stat in settings["stat_cols"]:
-        df[stat] = df[stat] * (settings["decay_rates"][stat] ** df["days_ago"])
-
-        # Reduce spring training and exhibition games
-        df[stat] = np.where(
-            df["game_type"] == SPRING_TRAINING, df[stat] * 0.45, df[stat]
-        )
-        df[stat] = np.where(df["game_type"] == EXHIBITION, df[stat] * 0.45, df[stat])
-
-        # Reduce minor league stats
-        df[stat] = np.where(
-            df["league_id"] == AAA, df[stat] * settings["aaa_factors"][stat], df[stat]
-        )
-        df[stat] = np.where(
-            df["league_id"] == AA, df[stat] * settings["aa_factors"][stat], df[stat]
-        )
-        df[stat] = np.where(
-            df["league_id"] == HIGH_A,
-            df[stat] * settings["high_a_factors"][stat],
-            df[stat],
-        )
-        df[stat] = np.where(
-            df["league_id"] == LOW_A,
-            df[stat] * settings["low_a_factors"][stat],
-            df[stat],
-        )
-        df[stat] = np.where(
-            df["league_id"] == ROOKIE,
-            df[stat] * settings["rookie_factors"][stat],
-            df[stat],
-        )
-        df[stat] = np.where(
-            df["league_id"] == FALL, df[stat] * settings["fall_factors"][stat], df[stat]
-        )
-
-    pr = df.groupby(["player_id"]).sum()
-    pr = pr[settings["stat_cols"]]
-
     if is_batting:
         appearances = "PA"
         pr[appearances] = pr["AB"] + pr["BB"] + pr["HBP"] + pr["SH"] + pr["SF"]
@@ -127,39 +61,25 @@ def project(projection_date_str, settings, is_batting):
     pr = pr.drop("projected_pa", 1)
     pr = pr.drop("start_pct", 1)
 
-    # Add names to the data for easy readability
-    pr = pr.join(load_names(), how="left")
-
-    print(pr.head())
-    save_projection(projection_date_str, pr, is_batting)
+    return pr
 
-def load_gamelogs(is_batting):
-    df = pd.DataFrame()
 
-    filepath = Path(__file__).parent
-    if is_batting:
-        df = pd.read_csv(filepath / "stats" / "batting.csv")
-    else:
-        df = pd.read_csv(filepath / "stats" / "pitching.csv")
+def weight_rows(df, settings, is_batting):
 
-        df["IP"] = df["IP"].map(convert_ip)
+    # Weight stats by decay rate, and reduce spring training, exhibition and minor league
+    # stats, for the whole block of stats at once
+    weights = weighting.compile_weights(settings, settings["stat_cols"], projection_engine.MAX_DAYS_AGO)
+    return pd.DataFrame(weighting.weight_stats(weights, df), index=df.index, columns=settings["stat_cols"])
 
-    return df
 
-# Convert IP fractional notation (.1 .2) to true decimals (.33 .67)
-def convert_ip(ip):
-    return int(ip) + (ip % 1 * 10 / 3)
+def get_rates(settings, is_batting):
+    return pd.Series(settings["decay_rates"])[settings["stat_cols"]]
 
 
-def load_names():
+def league_cols(settings, is_batting):
 
-    names = pd.DataFrame()
-    names = pd.read_csv("https://raw.githubusercontent.com/chadwickbureau/register/master/data/people.csv", low_memory=False)
-
-    names = names[["key_mlbam", "name_last", "name_first"]]
-    names.set_index("key_mlbam", inplace=True)
-
-    return names
+    # League average comes from the projected players themselves, in finish
+    return []
 
 
 def save_projection(date, df, is_batting):
@@ -544,6 +464,18 @@ PITCHING = {
     },
 }
 
+MODEL = {
+    "name": "aparicio",
+    "batting": BATTING,
+    "pitching": PITCHING,
+    "weight_rows": weight_rows,
+    "get_rates": get_rates,
+    "league_cols": league_cols,
+    "finish": finish,
+    "load_names": name_register.load_names,
+    "save_projection": save_projection,
+}
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,88 @@
+import gzip
+import hashlib
+import os
+import threading
+import time
+from pathlib import Path
+
+CACHE_DIR = Path(__file__).parent / "cache"
+
+# Final boxscores never change, so they're kept forever.
+# Schedules can still change (postponements, games going final), so they expire.
+BOXSCORE_TTL = None
+SCHEDULE_TTL = 60 * 60
+
+
+def boxscore_key(game_id):
+    return "boxscore/{}".format(game_id)
+
+
+def schedule_key(sportId, date_string):
+    return "schedule/{}/{}".format(sportId, date_string)
+
+
+def read(key, max_age=None, cache_dir=None):
+
+    cache_dir = cache_dir or CACHE_DIR
+
+    # Each key points at a compressed response stored under the hash of its contents
+    ref = cache_dir / "refs" / key
+    try:
+        digest = ref.read_text()
+        fetched_at = ref.stat().st_mtime
+    except FileNotFoundError:
+        return None
+
+    if max_age is not None and time.time() - fetched_at > max_age:
+        return None
+
+    try:
+        return gzip.decompress(object_path(digest, cache_dir).read_bytes())
+    except FileNotFoundError:
+        return None
+
+
+def write(key, content, cache_dir=None):
+
+    cache_dir = cache_dir or CACHE_DIR
+
+    # Identical responses (like empty offseason schedules) are only stored once
+    digest = hashlib.sha256(content).hexdigest()
+    path = object_path(digest, cache_dir)
+    if not path.exists():
+        atomic_write(path, gzip.compress(content))
+
+    atomic_write(cache_dir / "refs" / key, digest.encode())
+
+
+def prune(cache_dir=None):
+
+    cache_dir = cache_dir or CACHE_DIR
+
+    # Remove stored responses that no key points at anymore
+    refs = cache_dir / "refs"
+    live = {ref.read_text() for ref in refs.rglob("*") if ref.is_file()} if refs.exists() else set()
+
+    removed = 0
+    objects = cache_dir / "objects"
+    if objects.exists():
+        for path in objects.rglob("*.json.gz"):
+            if path.name[:-len(".json.gz")] not in live:
+                path.unlink()
+                removed += 1
+
+    return removed
+
+
+def object_path(digest, cache_dir):
+    return cache_dir / "objects" / digest[:2] / (digest + ".json.gz")
+
+
+def atomic_write(path, data):
+
+    # Write next to the destination and swap it in, so readers on other threads
+    # never see a partial file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name("{}.{}.{}.tmp".format(path.name, os.getpid(), threading.get_ident()))
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
@@ -0,0 +1,95 @@
+import argparse
+import sqlite3
+import tempfile
+from pathlib import Path
+
+import api_cache
+import build_logs
+import statsapi_stub
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark build_logs against the local Stats API stand-in")
+    parser.add_argument("--fixtures", help="recorded fixtures to replay (default: synthesize a month)")
+    parser.add_argument("--month", default="2021-07", help="YYYY-MM to build with build_monthly_gamelogs")
+    parser.add_argument("--day", help="YYYY-MM-DD to build with build_daily_gamelogs instead")
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--concurrency", type=int, default=build_logs.CONCURRENCY)
+    parser.add_argument("--batch-games", type=int, default=build_logs.BATCH_GAMES)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+
+        if args.fixtures:
+            fixture_dir = Path(args.fixtures)
+        else:
+            fixture_dir = tmp_dir / "fixtures"
+            year, month = args.month.split("-")
+            dates = build_logs.get_month_dates(year, month)
+            statsapi_stub.synthesize_fixtures(dates[0], dates[-1], fixture_dir)
+
+        server = statsapi_stub.serve(fixture_dir, 0, args.latency, args.jitter, args.error_rate, args.throttle_rate)
+        try:
+            results = run(server.url, tmp_dir, args)
+        finally:
+            server.shutdown()
+
+    report(results)
+
+
+def run(api_url, tmp_dir, args):
+
+    # Point build_logs at the stand-in, with an empty database and cache
+    build_logs.API_URL = api_url
+    api_cache.CACHE_DIR = tmp_dir / "cache"
+    db_path = tmp_dir / "gamelogs.db"
+
+    options = {"concurrency": args.concurrency, "batch_games": args.batch_games, "db_path": db_path}
+    if args.day:
+        summary = build_logs.build_daily_gamelogs(args.day, **options)
+    else:
+        year, month = args.month.split("-")
+        summary = build_logs.build_monthly_gamelogs(year, month, **options)
+
+    con = sqlite3.connect(db_path)
+    games = con.execute("SELECT COUNT(*) FROM ingested_games").fetchone()[0]
+    rows = con.execute("SELECT SUM(batting_rows + pitching_rows) FROM ingested_games").fetchone()[0] or 0
+    con.close()
+
+    return {"games": games, "rows": rows, "summary": summary}
+
+
+def report(results):
+
+    summary = results["summary"]
+    elapsed = summary["elapsed"]
+    print("games:     {}".format(results["games"]))
+    print("rows:      {}".format(results["rows"]))
+    print("elapsed:   {:.2f}s".format(elapsed))
+    print("games/sec: {:.1f}".format(results["games"] / elapsed))
+    print("rows/sec:  {:.1f}".format(results["rows"] / elapsed))
+
+    print("retries:   {}".format(summary["counters"].get("retries", 0)))
+
+    # Network time is summed across concurrent requests, so it can exceed the elapsed time
+    split = {
+        "network": ["schedule_fetch", "boxscore_fetch"],
+        "parse": ["json_parse", "row_extract"],
+        "sqlite": ["sqlite_write"],
+    }
+    for name, phases in split.items():
+        total = sum(summary["phases"].get(phase, {}).get("total", 0.0) for phase in phases)
+        print("{:<10} {:.2f}s".format(name + ":", total))
+
+    for phase, stats in sorted(summary["phases"].items()):
+        print("  {:<15} n={:<6} mean={:.4f}s p50<={}s p95<={}s max={:.4f}s".format(
+            phase, stats["count"], stats["mean"], stats["p50"], stats["p95"], stats["max"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,107 +1,32 @@
 import pandas as pd
-from datetime import datetime
 from pathlib import Path
 
+import name_register
+import projection_engine
+import weighting
+
 def main():
     project_all("2021-04-01")
 
 
-def project_all(projection_date_str):
-    project(projection_date_str, BATTING, True)
-    project(projection_date_str, PITCHING, False)
+def project_all(projection_date_str, indexed=False):
+    projection_engine.project_all(projection_date_str, [MODEL], indexed=indexed)
 
 
-def project(projection_date_str, settings, is_batting):
+def finish(pr, lg_avgs, settings, is_batting):
 
-    MAX_DAYS_AGO = 2000
     PROJECTED_PA = 650
     PROJECTED_BF = 800
     MIN_RP_BF = 250
 
-    # Compared to the max appearances, what percentage does a player need to get a projection?
-    APPEARANCE_THRESHOLD = 0.10
-
-    # MLB's "GameTypes"
-    SPRING_TRAINING = "S"
-    EXHIBITION = "E"
-    REGULAR_SEASON = "R"
-    # POST_SEASON = "P"
-
-    # MLB's "SportIDs" for various leagues
-    MLB = 1
-    AAA = 11
-    AA = 12
-    HIGH_A = 13
-    LOW_A = 14
-    ROOKIE = 16
-    FALL = 17
-
-    # Load all player stats
-    df = load_gamelogs(is_batting)
-
-    # Calculate days ago
-    projection_date = datetime.strptime(projection_date_str, "%Y-%m-%d")
-    df["date"] = pd.to_datetime(df["date"], infer_datetime_format=True)
-
-    df["days_ago"] = (projection_date - df["date"]).dt.days
+    appearances = "PA" if is_batting else "BFP"
 
-    # Remove data before and after the projection window
-    df = df[df["days_ago"] <= MAX_DAYS_AGO]
-    df = df[df["days_ago"] > 0]
-
-    # Setup some initially calculated columns
-    df["UIBB"] = df["BB"] - df["IBB"]
+    # League averages, for the regression
     if is_batting:
-        appearances = "PA"
-        df[appearances] = df["AB"] + df["BB"] + df["HBP"] + df["SH"] + df["SF"]
-        df["1B"] = df["H"] - df["HR"] - df["3B"] - df["2B"]
+        lg_avg = lg_avgs["all"]
     else:
-        appearances = "BFP"
-
-    # Calculate league average before applying weights
-    lg_avg = df[df["league_id"] == MLB]
-    lg_avg = lg_avg[lg_avg["game_type"] == REGULAR_SEASON]
-    if is_batting:
-        lg_avg = lg_avg.groupby(["player_id"]).sum()
-        max_pa = lg_avg[appearances].max()
-        lg_avg = lg_avg[lg_avg[appearances] > (max_pa * APPEARANCE_THRESHOLD)]
-        lg_avg = lg_avg.mean()
-    else:
-        lg_avg_sp = lg_avg[lg_avg["GS"] == 1]
-        lg_avg_sp = lg_avg_sp.groupby(["player_id"]).sum()
-        max_pa = lg_avg_sp[appearances].max()
-        lg_avg_sp = lg_avg_sp[lg_avg_sp[appearances] > (max_pa * APPEARANCE_THRESHOLD)]
-        lg_avg_sp = lg_avg_sp.mean()
-
-        lg_avg_rp = lg_avg[lg_avg["GS"] == 0]
-        lg_avg_rp = lg_avg_rp.groupby(["player_id"]).sum()
-        max_pa = lg_avg_rp[appearances].max()
-        lg_avg_rp = lg_avg_rp[lg_avg_rp[appearances] > (max_pa * APPEARANCE_THRESHOLD)]
-        lg_avg_rp = lg_avg_rp.mean()
-
-
-    # Weight stats by decay rate
-    for stat in settings["base_stats"]:
-        df[stat + "_denom"] = df[appearances]
-        df[stat] = df[stat] * (settings["decay_rates"][stat] ** df["days_ago"]) 
-        df[stat + "_denom"] = df[stat + "_denom"] * (settings["decay_rates"][stat] ** df["days_ago"])
-
-        # Reduce spring training and exhibition games
-        df.loc[df["game_type"] == SPRING_TRAINING, stat] *= 0.45
-        df.loc[df["game_type"] == SPRING_TRAINING, stat + "_denom"] *= 0.45
-        df.loc[df["game_type"] == EXHIBITION, stat] *= 0.45
-        df.loc[df["game_type"] == EXHIBITION, stat + "_denom"] *= 0.45
-
-        # Reduce minor league stats
-        df.loc[df["league_id"] == AAA, stat] *= settings["aaa_factors"][stat]
-        df.loc[df["league_id"] == AA, stat] *= settings["aa_factors"][stat]
-        df.loc[df["league_id"] == HIGH_A, stat] *= settings["high_a_factors"][stat]
-        df.loc[df["league_id"] == LOW_A, stat] *= settings["low_a_factors"][stat]
-        df.loc[df["league_id"] == ROOKIE, stat] *= settings["rookie_factors"][stat]
-        df.loc[df["league_id"] == FALL, stat] *= settings["fall_factors"][stat]
-
-    # Combine a player's daily data into a single row
-    pr = df.groupby(["player_id"]).sum()
+        lg_avg_sp = lg_avgs["sp"]
+        lg_avg_rp = lg_avgs["rp"]
 
     if not is_batting:
         pr["start_pct"] = pr["GS"] / pr["G"]
@@ -149,41 +74,39 @@ def project(projection_date_str, settings, is_batting):
 
     pr = pr.multiply(pr["projected_pa"] / pr[appearances], axis="index")
 
-    pr = pr[settings["display_cols"]]
-    print(pr.head())
-
-    # Add names to the data for easy readability
-    pr = pr.join(load_names(), how="left")
-
-    save_projection(projection_date_str, pr, is_batting)
+    return pr[settings["display_cols"]]
 
-def load_gamelogs(is_batting):
-    df = pd.DataFrame()
 
-    filepath = Path(__file__).parent
-    if is_batting:
-        df = pd.read_csv(filepath / "stats" / "batting.csv")
-    else:
-        df = pd.read_csv(filepath / "stats" / "pitching.csv")
+def weight_rows(df, settings, is_batting):
 
-        df["IP"] = df["IP"].map(convert_ip)
+    # Weight stats by decay rate, and reduce spring training, exhibition and minor league
+    # stats, for the whole block of stats (and their denominators) at once. The other
+    # stats are summed as they are.
+    stats = settings["base_stats"]
+    weights = weighting.compile_weights(settings, stats, projection_engine.MAX_DAYS_AGO)
+    weighted = pd.DataFrame(
+        weighting.weight_stats(weights, df, "PA" if is_batting else "BFP"),
+        index=df.index,
+        columns=stats + [stat + "_denom" for stat in stats],
+    )
+    other_cols = get_rates(settings, is_batting).index[len(weighted.columns):]
 
-    return df
+    return pd.concat([weighted, df[other_cols]], axis=1)
 
-# Convert IP fractional notation (.1 .2) to true decimals (.33 .67)
-def convert_ip(ip):
-    return int(ip) + (ip % 1 * 10 / 3)
 
+def get_rates(settings, is_batting):
 
-def load_names():
+    # The decay rate of each weighted column, and 1 for the unweighted ones
+    appearances = "PA" if is_batting else "BFP"
+    stats = settings["base_stats"]
+    rates = pd.Series([settings["decay_rates"][stat] for stat in stats] * 2, stats + [stat + "_denom" for stat in stats])
+    other_cols = [col for col in dict.fromkeys(settings["display_cols"] + [appearances]) if col not in rates.index]
 
-    names = pd.DataFrame()
-    names = pd.read_csv("https://raw.githubusercontent.com/chadwickbureau/register/master/data/people.csv", low_memory=False)
+    return pd.concat([rates, pd.Series(1.0, other_cols)])
 
-    names = names[["key_mlbam", "name_last", "name_first"]]
-    names.set_index("key_mlbam", inplace=True)
 
-    return names
+def league_cols(settings, is_batting):
+    return settings["base_stats"] + ["PA" if is_batting else "BFP"]
 
 
 def save_projection(date, df, is_batting):
@@ -237,6 +160,9 @@ def load_player_projections(player_id, is_batting):
 
     return player 
 
+# Compared to the max appearances, what percentage does a player need to get a projection?
+APPEARANCE_THRESHOLD = 0.10
+
 BATTING = {
     "display_cols": [
         "PA",
@@ -629,6 +555,19 @@ PITCHING = {
     },
 }
 
+MODEL = {
+    "name": "blyleven",
+    "batting": BATTING,
+    "pitching": PITCHING,
+    "weight_rows": weight_rows,
+    "get_rates": get_rates,
+    "league_cols": league_cols,
+    "league_threshold": APPEARANCE_THRESHOLD,
+    "finish": finish,
+    "load_names": name_register.load_names,
+    "save_projection": save_projection,
+}
+
 
 if __name__ == "__main__":
     main()
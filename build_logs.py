@@ -1,201 +1,881 @@
 import requests
+import asyncio
+import json
+import logging
+import os
 import datetime
 import calendar
+import shutil
 import sqlite3
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
 from pathlib import Path
 
+import api_cache
+import ingest_metrics
+from request_controller import RequestController
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+API_URL = os.environ.get("STATSAPI_URL", "https://statsapi.mlb.com/api/v1")
+
+# MLB's "SportIDs" for MLB and the minor leagues we track
+SPORT_IDS = [1, 11, 12, 13, 14, 16, 17]
+
+# How many schedule/boxscore requests can be in flight at once
+CONCURRENCY = 16
+
+# Seconds to wait on a single request before giving up on it (and retrying)
+REQUEST_TIMEOUT = 30
+
+# Longest date span to ask for in a single schedule request
+SCHEDULE_DAYS = 31
+
+# How many games to buffer before writing them in a single transaction
+# (None waits until the whole build is finished)
+BATCH_GAMES = 500
+
+DB_PATH = Path(__file__).parent / "gamelogs.db"
+
+# Applied to every connection to the game log database. WAL lets projections
+# read while ingestion writes, and NORMAL sync is safe under WAL.
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -64000,
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+}
+
+# Version of the batting/pitching table layout, kept in PRAGMA user_version.
+# Version 2 stores game_date as a day number (days since 1970-01-01), game_type
+# as a code from GAME_TYPE_CODES and innings pitched as outs.
+SCHEMA_VERSION = 2
+
+EPOCH = datetime.date(1970, 1, 1)
+
+# MLB's "GameTypes"
+GAME_TYPE_CODES = {
+    "R": 0,   # Regular season
+    "S": 1,   # Spring training
+    "E": 2,   # Exhibition
+    "A": 3,   # All-Star game
+    "F": 4,   # Wild card
+    "D": 5,   # Division series
+    "L": 6,   # League championship series
+    "W": 7,   # World series
+    "P": 8,   # Playoffs
+    "C": 9,   # Championship
+    "I": 10,  # Intrasquad
+    "N": 11,  # Nineteenth century
+}
+
+
+def date_to_day(date_string):
+    return (datetime.date.fromisoformat(date_string) - EPOCH).days
+
+
+def day_to_date(day):
+    return (EPOCH + datetime.timedelta(days=int(day))).isoformat()
+
+
+def ip_to_outs(ip):
+
+    # Innings pitched come in baseball notation, where 6.2 is six innings and two outs
+    whole, _, outs = str(ip).partition(".")
+    return int(whole or 0) * 3 + int(outs or 0)
+
+
+# Boxscore field, column type and default for every stat we keep, in table order.
+# Fields set to None are derived from the other columns instead.
+BATTING_FIELDS = [
+    ("AB", "atBats", int, 0),
+    ("R", "runs", int, 0),
+    ("H", "hits", int, 0),
+    ("2B", "doubles", int, 0),
+    ("3B", "triples", int, 0),
+    ("HR", "homeRuns", int, 0),
+    ("RBI", "rbi", int, 0),
+    ("SB", "stolenBases", int, 0),
+    ("CS", "caughtStealing", int, 0),
+    ("BB", "baseOnBalls", int, 0),
+    ("SO", "strikeOuts", int, 0),
+    ("IBB", "intentionalWalks", int, 0),
+    ("HBP", "hitByPitch", int, 0),
+    ("SH", "sacBunts", int, 0),
+    ("SF", "sacFlies", int, 0),
+    ("GIDP", "groundIntoDoublePlay", int, 0),
+]
+PITCHING_FIELDS = [
+    ("W", "wins", int, 0),
+    ("L", "losses", int, 0),
+    ("G", "gamesPlayed", int, 0),
+    ("GS", "gamesStarted", int, 0),
+    ("CG", "completeGames", int, 0),
+    ("SHO", "shutouts", int, 0),
+    ("QS", None, int, 0),
+    ("SV", "saves", int, 0),
+    ("HLD", "holds", int, 0),
+    ("BFP", "battersFaced", int, 0),
+    ("outs", "inningsPitched", ip_to_outs, 0),
+    ("H", "hits", int, 0),
+    ("ER", "earnedRuns", int, 0),
+    ("R", "runs", int, 0),
+    ("HR", "homeRuns", int, 0),
+    ("SO", "strikeOuts", int, 0),
+    ("BB", "baseOnBalls", int, 0),
+    ("IBB", "intentionalWalks", int, 0),
+    ("HBP", "hitByPitch", int, 0),
+    ("WP", "wildPitches", int, 0),
+    ("BK", "balks", int, 0),
+]
+DERIVED_FIELDS = {
+    "QS": "1 if {GS} > 0 and {outs} >= 18 and {ER} <= 3 else 0",
+}
+
+GAME_COLS = ["game_date", "game_id", "game_type", "venue_id", "league_id", "player_id"]
+BATTING_COLS = GAME_COLS + ["batting_order"] + [field[0] for field in BATTING_FIELDS]
+PITCHING_COLS = GAME_COLS + [field[0] for field in PITCHING_FIELDS]
+
 
 def main():
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     setup_db()
     build_yearly_gamelogs("2021")
     #build_monthly_gamelogs("2020","12")
     #build_daily_gamelogs("2014-01-08")
+    #build_sharded_gamelogs("2016-01-01", "2021-12-31")
+
+def connect_db(db_path=DB_PATH):
+
+    con = sqlite3.connect(db_path, timeout=30)
+    for pragma, value in PRAGMAS.items():
+        con.execute("PRAGMA {} = {}".format(pragma, value))
+
+    return con
+
 
-def setup_db():
+def setup_db(db_path=DB_PATH):
     
-    filepath = Path(__file__).parent
-    con = sqlite3.connect(filepath / "gamelogs.db")
+    con = connect_db(db_path)
     cur = con.cursor()
 
+    # Databases from before version 2 are converted in place, once
+    tables = {row[0] for row in cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    version = cur.execute("PRAGMA user_version").fetchone()[0]
+    if "batting" in tables and version < SCHEMA_VERSION:
+        migrate_db(con)
+
     # Create tables
-    cur.execute('''CREATE TABLE IF NOT EXISTS batting
-                (game_date text, game_id integer, game_type text, venue_id integer, league_id integer,
-                 player_id integer, batting_order text, AB integer, R integer, H integer,
+    create_gamelog_tables(cur)
+    cur.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+
+    # Record of every game that's been loaded, so it never has to be fetched again
+    cur.execute('''CREATE TABLE IF NOT EXISTS ingested_games
+                (game_id integer PRIMARY KEY, game_date text, league_id integer, status text,
+                 fetched_at text, batting_rows integer, pitching_rows integer)''')
+
+    # Databases built before the manifest existed get one from the rows they already hold
+    if cur.execute("SELECT COUNT(*) FROM ingested_games").fetchone()[0] == 0:
+        cur.execute('''INSERT INTO ingested_games
+                    (game_id, game_date, league_id, status, batting_rows, pitching_rows)
+                    SELECT game_id, date(MAX(game_date) * 86400, 'unixepoch'), MAX(league_id), 'F',
+                           SUM(is_batting), SUM(is_pitching)
+                    FROM (SELECT game_id, game_date, league_id, 1 AS is_batting, 0 AS is_pitching FROM batting
+                          UNION ALL
+                          SELECT game_id, game_date, league_id, 0, 1 FROM pitching)
+                    GROUP BY game_id''')
+
+    # Progress of interrupted builds, and games that couldn't be fetched
+    cur.execute('''CREATE TABLE IF NOT EXISTS backfill_checkpoints
+                (job text PRIMARY KEY, last_date text, updated_at text)''')
+    cur.execute('''CREATE TABLE IF NOT EXISTS failed_games
+                (game_id integer PRIMARY KEY, game_date text, game_type text, venue_id integer,
+                 league_id integer, status text, error text, attempts integer, failed_at text)''')
+
+    con.commit()
+    con.close()
+
+
+def create_gamelog_tables(cur, suffix=""):
+
+    cur.execute('''CREATE TABLE IF NOT EXISTS batting{}
+                (game_date integer, game_id integer, game_type integer, venue_id integer, league_id integer,
+                 player_id integer, batting_order integer, AB integer, R integer, H integer,
                 "2B" integer, "3B" integer, HR integer, RBI integer, SB integer, CS integer, BB integer,
-                SO integer, IBB integer, HBP integer, SH integer, SF integer, GIDP integer)''')
-    cur.execute('''CREATE TABLE IF NOT EXISTS pitching
-                (game_date text, game_id integer, game_type text, venue_id integer, league_id integer,
+                SO integer, IBB integer, HBP integer, SH integer, SF integer, GIDP integer)'''.format(suffix))
+    cur.execute('''CREATE TABLE IF NOT EXISTS pitching{}
+                (game_date integer, game_id integer, game_type integer, venue_id integer, league_id integer,
                  player_id integer, W integer, L integer, G integer, GS integer, CG integer,
-                 SHO integer, QS integer, SV integer, HLD integer, BFP integer, IP real,
+                 SHO integer, QS integer, SV integer, HLD integer, BFP integer, outs integer,
                  H integer, ER integer, R integer, HR integer, SO integer, BB integer, IBB integer,
-                 HBP integer, WP integer, BK integer)''')
-    
+                 HBP integer, WP integer, BK integer)'''.format(suffix))
+
+    if suffix:
+        return
+
     cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_game_batter ON batting (game_id, player_id);")
     cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_game_pitcher ON pitching (game_id, player_id);")
+
+    # Projections read by date window and by player
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_batting_date_player ON batting (game_date, player_id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_batting_player_date ON batting (player_id, game_date);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_pitching_date_player ON pitching (game_date, player_id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_pitching_player_date ON pitching (player_id, game_date);")
+
+
+def migrate_db(con):
+
+    # Copy the version 1 tables (text dates and game types, IP as a float) into the
+    # version 2 layout, in date order so range scans read neighbouring pages
+    game_type = "CASE game_type {} END".format(
+        " ".join("WHEN '{}' THEN {}".format(code, value) for code, value in GAME_TYPE_CODES.items()))
+    game_date = "CAST(julianday(game_date) - 2440587.5 AS INTEGER)"
+    outs = "CAST(IP AS INTEGER) * 3 + CAST(ROUND((IP - CAST(IP AS INTEGER)) * 10) AS INTEGER)"
+
+    batting_stats = ", ".join('"{}"'.format(field[0]) for field in BATTING_FIELDS)
+    pitching_stats = ", ".join(
+        outs if field[0] == "outs" else '"{}"'.format(field[0]) for field in PITCHING_FIELDS)
+
+    with con:
+        con.execute("BEGIN")
+        create_gamelog_tables(con, "_v2")
+        con.execute('''INSERT INTO batting_v2
+                    SELECT {}, game_id, {}, venue_id, league_id, player_id,
+                           CAST(NULLIF(batting_order, '') AS INTEGER), {}
+                    FROM batting ORDER BY game_date, game_id'''.format(game_date, game_type, batting_stats))
+        con.execute('''INSERT INTO pitching_v2
+                    SELECT {}, game_id, {}, venue_id, league_id, player_id, {}
+                    FROM pitching ORDER BY game_date, game_id'''.format(game_date, game_type, pitching_stats))
+
+        con.execute("DROP TABLE batting")
+        con.execute("DROP TABLE pitching")
+        con.execute("ALTER TABLE batting_v2 RENAME TO batting")
+        con.execute("ALTER TABLE pitching_v2 RENAME TO pitching")
+        create_gamelog_tables(con)
+        con.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+
+    # Give the space from the old tables back
+    con.execute("VACUUM")
+    analyze_db(con, bulk=True)
+
+
+def build_yearly_gamelogs(year, **options):
+
+    game_dates = []
+    for month in range(1, 13):
+        game_dates += get_month_dates(year, month)
+
+    return build_gamelogs(game_dates, **options)
+
+
+def build_monthly_gamelogs(year, month, **options):
+
+    return build_gamelogs(get_month_dates(year, month), **options)
+
+
+def build_daily_gamelogs(date_string, **options):
+
+    return build_gamelogs([date_string], **options)
+
+
+def build_sharded_gamelogs(start_date, end_date, processes=None, db_path=DB_PATH, **options):
+
+    # SQLite only allows one writer, so each process loads its months into a shard
+    # of its own, and the shards are merged into the main database at the end
+    setup_db(db_path)
+    shard_dir = Path(db_path).parent / (Path(db_path).stem + "_shards")
+    shard_dir.mkdir(exist_ok=True)
+
+    # Shards left behind by an interrupted backfill are merged before starting over
+    merge_shards(sorted(shard_dir.glob("*.db")), db_path)
+    for shard_path in shard_dir.iterdir():
+        shard_path.unlink()
+
+    start = datetime.date.fromisoformat(start_date)
+    end = datetime.date.fromisoformat(end_date)
+    date_strings = [(start + datetime.timedelta(days=i)).isoformat() for i in range((end - start).days + 1)]
+
+    months = {}
+    for date_string in date_strings:
+        months.setdefault(date_string[:7], []).append(date_string)
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = [
+            pool.submit(build_shard, month_dates, shard_dir, db_path, options)
+            for month_dates in months.values()
+        ]
+        wait(futures)
+
+    # Whatever finished is kept even if another month failed; the manifest
+    # means a rerun only fetches what's missing
+    merge_shards(sorted(shard_dir.glob("*.db")), db_path)
+    shutil.rmtree(shard_dir)
+
+    for future in futures:
+        future.result()
+
+
+def build_shard(date_strings, shard_dir, db_path, options):
+
+    shard_path = shard_dir / "shard_{}.db".format(os.getpid())
+    setup_db(shard_path)
+
+    # Start from the main manifest for these dates, so loaded games are still skipped
+    con = connect_db(shard_path)
+    con.execute("ATTACH DATABASE ? AS main_db", (str(db_path),))
+    with con:
+        con.execute('''INSERT OR IGNORE INTO ingested_games
+                    SELECT * FROM main_db.ingested_games WHERE game_date BETWEEN ? AND ?''',
+                    (min(date_strings), max(date_strings)))
+    con.execute("DETACH DATABASE main_db")
     con.close()
 
+    build_gamelogs(date_strings, db_path=shard_path, **options)
+
 
-def build_yearly_gamelogs(year):
+def merge_shards(shard_paths, db_path=DB_PATH):
+
+    con = connect_db(db_path)
+
+    for shard_path in shard_paths:
+        con.execute("ATTACH DATABASE ? AS shard", (str(shard_path),))
+        with con:
+            for table in ["batting", "pitching", "ingested_games", "failed_games"]:
+                con.execute("REPLACE INTO main.{0} SELECT * FROM shard.{0}".format(table))
+            con.execute("DELETE FROM main.failed_games WHERE game_id IN (SELECT game_id FROM shard.ingested_games)")
+        con.execute("DETACH DATABASE shard")
+
+    analyze_db(con, bulk=True)
+    con.close()
 
 
-    months = ["01","02","03","04","05","06","07","08","09","10","11","12"]
+def analyze_db(con, bulk=False):
 
-    for month in months:
-        build_monthly_gamelogs(year, month)
+    # Refresh the query planner's statistics. A full ANALYZE is only worth it after
+    # a bulk load; otherwise SQLite decides whether anything needs redoing.
+    if bulk:
+        con.execute("ANALYZE")
+    else:
+        con.execute("PRAGMA optimize")
 
 
-def build_monthly_gamelogs(year, month):
+def get_month_dates(year, month):
 
     # Get a list of days in the month
     num_days = calendar.monthrange(int(year), int(month))[1]
     game_dates = [datetime.date(int(year), int(month), day) for day in range(1, num_days + 1)]
 
-    for game_date in game_dates:
-        build_daily_gamelogs(game_date.strftime("%Y-%m-%d"))
+    return [game_date.strftime("%Y-%m-%d") for game_date in game_dates]
 
 
-def build_daily_gamelogs(date_string):
+def get_range_dates(start_date, end_date, step=1):
 
-    games = []
-        
-    print(date_string)
-     # Get a list of game ids for games on this date
-    games = get_games(date_string)
+    # Every step days from start_date through end_date
+    days = range(date_to_day(start_date), date_to_day(end_date) + 1, step)
+    return [day_to_date(day) for day in days]
 
-    filepath = Path(__file__).parent
-    con = sqlite3.connect(filepath / "gamelogs.db")
-    cur = con.cursor()
 
-    # For each game, get the stats for every player
-    for game in games:
-        game_batting, game_pitching = get_game_logs(game)
-
-        # Insert into DB
-        for row in game_batting:
-            cur.execute('''REPLACE INTO batting VALUES
-                        (:game_date, :game_id, :game_type, :venue_id, :league_id,
-                         :player_id, :batting_order, :AB, :R, :H, :2B, :3B, 
-                         :HR, :RBI, :SB, :CS, :BB, :SO, :IBB, :HBP, :SH,
-                         :SF, :GIDP)''', row)
-        
-        for row in game_pitching:
-            cur.execute('''REPLACE INTO pitching VALUES
-                        (:game_date, :game_id, :game_type, :venue_id, :league_id,
-                         :player_id, :W, :L, :G, :GS, :CG, :SHO, :QS, :SV, 
-                         :HLD, :BFP, :IP, :H, :ER, :R, :HR, :SO, :BB, :IBB,
-                         :HBP, :WP, :BK)''', row)
-        
-    
-    con.commit()
+def build_gamelogs(date_strings, **options):
+
+    return asyncio.run(ingest_gamelogs(date_strings, **options))
+
+
+def retry_failed_games(**options):
+
+    # Fetch the games in the retry journal again, without rediscovering their dates
+    con = connect_db(options.get("db_path", DB_PATH))
+    con.row_factory = sqlite3.Row
+    games = [
+        {
+            "date": row["game_date"],
+            "game_id": row["game_id"],
+            "game_type": row["game_type"],
+            "venue_id": row["venue_id"],
+            "league_id": row["league_id"],
+            "status": row["status"],
+        }
+        for row in con.execute("SELECT * FROM failed_games ORDER BY game_date")
+    ]
     con.close()
 
+    if games:
+        return asyncio.run(ingest_gamelogs([game["date"] for game in games], games=games, **options))
+
+
+async def ingest_gamelogs(date_strings, games=None, concurrency=CONCURRENCY, batch_games=BATCH_GAMES,
+                          db_path=DB_PATH, offline=False, force=False, resume=True):
+
+    date_strings = sorted({datetime.date.fromisoformat(d).isoformat() for d in date_strings})
+
+    # Counters and timings for this build, summarized when it's done
+    ingest_metrics.start()
+    metrics = ingest_metrics.current()
+
+    # Every request shares one pool of keep-alive connections,
+    # and the controller decides how many of them are busy at a time.
+    # Offline builds have no session and only read from the response cache.
+    session = None if offline else new_session(concurrency)
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    controller = RequestController(executor, concurrency)
+
+    setup_db(db_path)
+    con = connect_db(db_path)
+
+    # A build over a span of dates checkpoints its progress as it goes,
+    # and an interrupted one picks up after the last date it committed
+    job = None
+    if games is None:
+        job = "{}..{}".format(date_strings[0], date_strings[-1])
+        last_date = get_checkpoint(con, job) if resume else None
+        if last_date:
+            date_strings = [d for d in date_strings if d > last_date]
+
+    writer = GamelogWriter(con, batch_games, job)
+
+    # Games that were already loaded in their final state are skipped, unless forced
+    loaded = set() if force else get_loaded_games(con)
+
+    completed = False
+    try:
+        # Find every finished game in the date span with a handful of schedule requests
+        if games is None:
+            games = await discover_games(session, controller, date_strings)
+        metrics.count("games_discovered", len(games))
+        games = [game for game in games if game["game_id"] not in loaded]
+        metrics.count("games_skipped", metrics.counters["games_discovered"] - len(games))
+
+        # Dates are done once all of their games are written or journaled
+        remaining = {date_string: 0 for date_string in date_strings}
+        for game in games:
+            remaining[game["date"]] += 1
+        pending_dates = iter(date_strings)
+        next_date = next(pending_dates, None)
+
+        # For each game, get the stats for every player. Games are buffered as soon as
+        # they arrive; ones that still fail after retrying go in the retry journal
+        # instead of stopping the build.
+        async for game, game_logs, error in fetch_all_game_logs(session, controller, games, concurrency * 2):
+            remaining[game["date"]] -= 1
+
+            while next_date is not None and remaining[next_date] == 0:
+                writer.last_date = next_date
+                next_date = next(pending_dates, None)
+
+            if error:
+                ingest_metrics.emit("game_failed", logging.WARNING, game_id=game["game_id"], error=repr(error))
+                metrics.count("games_failed")
+                writer.fail(game, error)
+            else:
+                metrics.count("games_fetched")
+                writer.add(game, *game_logs)
+
+        while next_date is not None and remaining[next_date] == 0:
+            writer.last_date = next_date
+            next_date = next(pending_dates, None)
+
+        writer.flush()
+
+        # A finished build doesn't need its checkpoint anymore
+        if job:
+            with con:
+                con.execute("DELETE FROM backfill_checkpoints WHERE job = ?", (job,))
+
+        analyze_db(con, bulk=bool(batch_games) and len(games) >= batch_games)
+        completed = True
+    finally:
+        con.close()
+        executor.shutdown(wait=False, cancel_futures=True)
+        if session:
+            session.close()
+
+        metrics.count("retries", controller.retry_count)
+        summary = metrics.summary()
+        summary["job"] = job
+        summary["completed"] = completed
+        summary["concurrency_limit"] = round(controller.limit, 2)
+        ingest_metrics.emit("ingest_summary", **summary)
+
+    return summary
+
+
+async def discover_games(session, controller, date_strings):
+
+    # One request per league for each span of consecutive dates
+    schedules = await asyncio.gather(*[
+        controller.run(get_sport_games, start_date, end_date, sportId, session)
+        for start_date, end_date in get_date_ranges(date_strings)
+        for sportId in SPORT_IDS
+    ])
+
+    games = select_games(schedules, date_strings)
+
+    for date_string in sorted({game["date"] for game in games}):
+        ingest_metrics.emit("date_discovered", date=date_string,
+                            games=sum(game["date"] == date_string for game in games))
+
+    return games
 
 
-def get_games(date_string):
+def select_games(schedules, date_strings=None):
 
-    games = []
-    sportIds = [1, 11, 12, 13, 14, 16, 17]
+    # A suspended game is listed again on the day it's finished, so keep its last date
+    wanted = {datetime.date.fromisoformat(d).isoformat() for d in date_strings} if date_strings else None
+    games = {}
+    for sport_games in schedules:
+        for game in sport_games:
+            if wanted is None or game["date"] in wanted:
+                if game["game_id"] not in games or game["date"] > games[game["game_id"]]["date"]:
+                    games[game["game_id"]] = game
 
-    for sportId in sportIds:
-        url = "https://statsapi.mlb.com/api/v1/schedule/?sportId={}&date={}".format(
+    return sorted(games.values(), key=lambda game: game["date"])
+
+
+async def fetch_all_game_logs(session, controller, games, window):
+
+    # Only a window of games is in progress at once, taken in date order,
+    # so days finish (and can be checkpointed) roughly in order
+    pending = set()
+    for game in games:
+        pending.add(asyncio.ensure_future(fetch_game_logs(session, controller, game)))
+
+        if len(pending) >= window:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            yield task.result()
+
+
+async def fetch_game_logs(session, controller, game):
+
+    try:
+        game_logs = await controller.run(get_game_logs, game, session)
+    except Exception as error:
+        return game, None, error
+
+    return game, game_logs, None
+
+
+def get_date_ranges(date_strings, max_days=SCHEDULE_DAYS):
+
+    # Split the dates into runs of consecutive days no longer than max_days
+    ranges = []
+    for game_date in sorted({datetime.date.fromisoformat(d) for d in date_strings}):
+        if ranges:
+            start_date, end_date = ranges[-1]
+            if game_date - end_date == datetime.timedelta(days=1) and (game_date - start_date).days < max_days:
+                ranges[-1] = (start_date, game_date)
+                continue
+        ranges.append((game_date, game_date))
+
+    return [(start_date.isoformat(), end_date.isoformat()) for start_date, end_date in ranges]
+
+
+def new_session(concurrency=CONCURRENCY):
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return session
+
+
+def fetch_json(session, url, cache_key, max_age):
+    return decode_json(fetch_content(session, url, cache_key, max_age))
+
+
+def fetch_content(session, url, cache_key, max_age):
+
+    # Read through the local response cache first
+    content = read_cached(session, cache_key, max_age)
+    if content is None:
+        if session is None:
+            raise LookupError("{} is not cached and the build is offline".format(cache_key))
+
+        content = download(session, url, cache_key.split("/")[0])
+        api_cache.write(cache_key, content)
+
+    return content
+
+
+def read_cached(session, cache_key, max_age):
+
+    # Offline builds take whatever is cached, however old
+    metrics = ingest_metrics.current()
+    with metrics.timed("cache_read"):
+        content = api_cache.read(cache_key, None if session is None else max_age)
+    if content is not None:
+        metrics.count("cache_hits")
+
+    return content
+
+
+def download(session, url, kind):
+
+    metrics = ingest_metrics.current()
+    with metrics.timed(kind + "_fetch"):
+        response = session.get(url, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        content = response.content
+    metrics.count("bytes_downloaded", len(content))
+    metrics.count(kind + "_requests")
+
+    return content
+
+
+def decode_json(content):
+
+    with ingest_metrics.current().timed("json_parse"):
+        if orjson:
+            return orjson.loads(content)
+        return json.loads(content)
+
+
+class GamelogWriter:
+
+    def __init__(self, con, batch_games=BATCH_GAMES, job=None):
+        self.con = con
+        self.batch_games = batch_games
+        self.job = job
+        self.last_date = None
+        self.batting = []
+        self.pitching = []
+        self.manifest = []
+        self.failures = []
+        self.games = 0
+
+    def add(self, game, game_batting, game_pitching):
+        self.batting += game_batting
+        self.pitching += game_pitching
+        self.manifest.append((
+            int(game["game_id"]),
+            game["date"],
+            int(game["league_id"]),
+            game["status"],
+            datetime.datetime.now().isoformat(timespec="seconds"),
+            len(game_batting),
+            len(game_pitching),
+        ))
+        self.games += 1
+
+        if self.batch_games and self.games >= self.batch_games:
+            self.flush()
+
+    def fail(self, game, error):
+        self.failures.append((
+            int(game["game_id"]),
+            game["date"],
+            game["game_type"],
+            int(game["venue_id"]),
+            int(game["league_id"]),
+            game["status"],
+            repr(error),
+            datetime.datetime.now().isoformat(timespec="seconds"),
+        ))
+        self.games += 1
+
+        if self.batch_games and self.games >= self.batch_games:
+            self.flush()
+
+    def flush(self):
+        if not self.games and not self.last_date:
+            return
+
+        metrics = ingest_metrics.current()
+        changes = self.con.total_changes
+
+        # Everything buffered goes out in one transaction, along with how far the build has gotten
+        with metrics.timed("sqlite_write"), self.con:
+            self.con.executemany(upsert_sql("batting", BATTING_COLS), self.batting)
+            self.con.executemany(upsert_sql("pitching", PITCHING_COLS), self.pitching)
+            changes = self.con.total_changes - changes
+            self.con.executemany("REPLACE INTO ingested_games VALUES (?, ?, ?, ?, ?, ?, ?)", self.manifest)
+            self.con.executemany("DELETE FROM failed_games WHERE game_id = ?", [row[:1] for row in self.manifest])
+            self.con.executemany('''INSERT INTO failed_games VALUES (?, ?, ?, ?, ?, ?, ?, 1, ?)
+                                    ON CONFLICT (game_id) DO UPDATE SET error = excluded.error,
+                                    attempts = attempts + 1, failed_at = excluded.failed_at''', self.failures)
+
+            if self.job and self.last_date:
+                self.con.execute("REPLACE INTO backfill_checkpoints VALUES (?, ?, ?)", (
+                    self.job,
+                    self.last_date,
+                    datetime.datetime.now().isoformat(timespec="seconds"),
+                ))
+
+        # Rows for games that were already loaded are skipped when nothing changed
+        submitted = len(self.batting) + len(self.pitching)
+        metrics.count("rows_submitted", submitted)
+        metrics.count("rows_written", changes)
+        metrics.count("rows_unchanged", submitted - changes)
+
+        self.batting = []
+        self.pitching = []
+        self.manifest = []
+        self.failures = []
+        self.games = 0
+
+
+def get_checkpoint(con, job):
+
+    row = con.execute("SELECT last_date FROM backfill_checkpoints WHERE job = ?", (job,)).fetchone()
+    return row[0] if row else None
+
+
+def get_loaded_games(con):
+
+    rows = con.execute("SELECT game_id FROM ingested_games WHERE status = 'F'").fetchall()
+    return {row[0] for row in rows}
+
+
+def upsert_sql(table, cols):
+
+    # Rows for a game that's already loaded are only rewritten if a stat changed
+    values = ", ".join("?" for col in cols)
+    stat_cols = ['"{}"'.format(col) for col in cols if col not in ("game_id", "player_id")]
+    updates = ", ".join("{0} = excluded.{0}".format(col) for col in stat_cols)
+    old = ", ".join("{}.{}".format(table, col) for col in stat_cols)
+    new = ", ".join("excluded." + col for col in stat_cols)
+
+    return '''INSERT INTO {} VALUES ({})
+              ON CONFLICT (game_id, player_id) DO UPDATE SET {}
+              WHERE ({}) IS NOT ({})'''.format(table, values, updates, old, new)
+
+
+def get_sport_games(start_date, end_date, sportId, session=requests):
+
+    # Schedules are cached a date at a time, so any span of dates can be rebuilt from
+    # the cache. Only the runs of dates that aren't cached are requested.
+    schedules = {}
+    missing = []
+    for date_string in get_range_dates(start_date, end_date):
+        content = read_cached(session, api_cache.schedule_key(sportId, date_string), api_cache.SCHEDULE_TTL)
+        if content is None:
+            missing.append(date_string)
+        else:
+            schedules[date_string] = decode_json(content)
+
+    if missing and session is None:
+        raise LookupError("{} is not cached and the build is offline".format(api_cache.schedule_key(sportId, missing[0])))
+
+    for range_start, range_end in get_date_ranges(missing):
+        url = "{}/schedule/?sportId={}&startDate={}&endDate={}".format(
+            API_URL,
             sportId,
-            date_string
+            range_start,
+            range_end
         )
-        schedule = requests.get(url).json()
-
-        for date in schedule["dates"]:
-            for game_data in date["games"]:
-                # Skip games that are not finished ("F")
-                # If a game was delayed, it will show up again on a later calendar date
-                if game_data["status"]["codedGameState"] == "F":
-                    game = {}
-                    game["date"] = date_string
-                    game["game_id"] = game_data["gamePk"]
-                    game["game_type"] = game_data["gameType"]
-                    game["venue_id"] = game_data["venue"]["id"]
-                    game["league_id"] = sportId
-                    games.append(game)
+        schedule = decode_json(download(session, url, "schedule"))
+
+        # Split the response into each date's schedule, including the dates without games
+        dates = {date["date"]: date for date in schedule["dates"]}
+        for date_string in get_range_dates(range_start, range_end):
+            schedules[date_string] = {"dates": [dates[date_string]] if date_string in dates else []}
+            api_cache.write(api_cache.schedule_key(sportId, date_string), json.dumps(schedules[date_string]).encode())
+
+    games = []
+    for date_string in sorted(schedules):
+        games += parse_schedule(schedules[date_string], sportId)
+
+    return games
+
+
+def parse_schedule(schedule, sportId):
+
+    games = []
+    for date in schedule["dates"]:
+        for game_data in date["games"]:
+            # Skip games that are not finished ("F")
+            # If a game was delayed, it will show up again on a later calendar date
+            if game_data["status"]["codedGameState"] == "F":
+                game = {}
+                game["date"] = date["date"]
+                game["game_id"] = game_data["gamePk"]
+                game["game_type"] = game_data["gameType"]
+                game["venue_id"] = game_data["venue"]["id"]
+                game["league_id"] = sportId
+                game["status"] = game_data["status"]["codedGameState"]
+                games.append(game)
 
     return games
 
 
-def get_game_logs(game):
+def get_game_logs(game, session=requests):
+
+    url = "{}/game/{}/boxscore".format(API_URL, game["game_id"])
+    # Only final games get here, so their boxscores can be cached for good
+    game_info = fetch_json(session, url, api_cache.boxscore_key(game["game_id"]), api_cache.BOXSCORE_TTL)
+
+    with ingest_metrics.current().timed("row_extract"):
+        game_logs = parse_game_logs(game, game_info)
+
+    ingest_metrics.emit("game_fetched", logging.DEBUG, game_id=game["game_id"],
+                        batting_rows=len(game_logs[0]), pitching_rows=len(game_logs[1]))
+    return game_logs
+
+
+def parse_game_logs(game, game_info):
 
     batting_logs = []
     pitching_logs = []
-    url = "https://statsapi.mlb.com/api/v1/game/{}/boxscore".format(game["game_id"])
-    game_info = requests.get(url).json()
 
-    print(game["game_id"])
+    game_row = (
+        date_to_day(game["date"]),
+        int(game["game_id"]),
+        GAME_TYPE_CODES[game["game_type"]],
+        int(game["venue_id"]),
+        int(game["league_id"]),
+    )
+
     if "teams" in game_info:
         for team in game_info["teams"].values():
             for player in team["players"].values():
-                if player["stats"]["batting"]:
-                    batting_log = {}
-                    batting_log["game_date"] = game["date"]
-                    batting_log["game_id"] = int(game["game_id"])
-                    batting_log["game_type"] = game["game_type"]
-                    batting_log["venue_id"] = int(game["venue_id"])
-                    batting_log["league_id"] = int(game["league_id"])
-                    batting_log["player_id"] = int(player["person"]["id"])
-                    batting_log["batting_order"] = player.get("battingOrder", "")
-                    batting_log["AB"] = int(player["stats"]["batting"]["atBats"])
-                    batting_log["R"] = int(player["stats"]["batting"]["runs"])
-                    batting_log["H"] = int(player["stats"]["batting"]["hits"])
-                    batting_log["2B"] = int(player["stats"]["batting"]["doubles"])
-                    batting_log["3B"] = int(player["stats"]["batting"]["triples"])
-                    batting_log["HR"] = int(player["stats"]["batting"]["homeRuns"])
-                    batting_log["RBI"] = int(player["stats"]["batting"]["rbi"])
-                    batting_log["SB"] = int(player["stats"]["batting"]["stolenBases"])
-                    batting_log["CS"] = int(player["stats"]["batting"]["caughtStealing"])
-                    batting_log["BB"] = int(player["stats"]["batting"]["baseOnBalls"])
-                    batting_log["SO"] = int(player["stats"]["batting"]["strikeOuts"])
-                    batting_log["IBB"] = int(player["stats"]["batting"]["intentionalWalks"])
-                    batting_log["HBP"] = int(player["stats"]["batting"]["hitByPitch"])
-                    batting_log["SH"] = int(player["stats"]["batting"]["sacBunts"])
-                    batting_log["SF"] = int(player["stats"]["batting"]["sacFlies"])
-                    batting_log["GIDP"] = int(player["stats"]["batting"]["groundIntoDoublePlay"])
-
-                    batting_logs.append(batting_log)
-
-                if player["stats"]["pitching"]:
-                    pitching_log = {}
-                    pitching_log["game_date"] = game["date"]
-                    pitching_log["game_id"] = int(game["game_id"])
-                    pitching_log["game_type"] = game["game_type"]
-                    pitching_log["venue_id"] = int(game["venue_id"])
-                    pitching_log["league_id"] = int(game["league_id"])
-                    pitching_log["player_id"] = int(player["person"]["id"])
-                    pitching_log["W"] = int(player["stats"]["pitching"].get("wins", ""))
-                    pitching_log["L"] = int(player["stats"]["pitching"].get("losses", ""))
-                    pitching_log["G"] = int(player["stats"]["pitching"].get("gamesPlayed", ""))
-                    pitching_log["GS"] = int(player["stats"]["pitching"].get("gamesStarted", ""))
-                    pitching_log["CG"] = int(player["stats"]["pitching"].get("completeGames", ""))
-                    pitching_log["SHO"] = int(player["stats"]["pitching"].get("shutouts", ""))
-                    pitching_log["SV"] = int(player["stats"]["pitching"].get("saves", ""))
-                    pitching_log["HLD"] = int(player["stats"]["pitching"].get("holds", ""))
-                    pitching_log["BFP"] = int(player["stats"]["pitching"].get("battersFaced", ""))
-                    pitching_log["IP"] = float(player["stats"]["pitching"].get("inningsPitched", ""))
-                    pitching_log["H"] = int(player["stats"]["pitching"].get("hits", ""))
-                    pitching_log["ER"] = int(player["stats"]["pitching"].get("earnedRuns", ""))
-                    pitching_log["R"] = int(player["stats"]["pitching"].get("runs", ""))
-                    pitching_log["HR"] = int(player["stats"]["pitching"].get("homeRuns", ""))
-                    pitching_log["SO"] = int(player["stats"]["pitching"].get("strikeOuts", ""))
-                    pitching_log["BB"] = int(player["stats"]["pitching"].get("baseOnBalls", ""))
-                    pitching_log["IBB"] = int(player["stats"]["pitching"].get("intentionalWalks", ""))
-                    pitching_log["HBP"] = int(player["stats"]["pitching"].get("hitByPitch", ""))
-                    pitching_log["WP"] = int(player["stats"]["pitching"].get("wildPitches", ""))
-                    pitching_log["BK"] = int(player["stats"]["pitching"].get("balks", ""))
-
-                    if pitching_log["GS"] > 0 and pitching_log["IP"] >= 6 and pitching_log["ER"] <= 3:
-                        pitching_log["QS"] = 1
-                    else:
-                        pitching_log["QS"] = 0
-
-                    pitching_logs.append(pitching_log)
+                stats = player["stats"]
+                player_id = int(player["person"]["id"])
+
+                # Rows come out as tuples in table column order
+                if stats["batting"]:
+                    row = game_row + (player_id, int(player["battingOrder"]) if "battingOrder" in player else None)
+                    batting_logs.append(extract_batting(row, stats["batting"]))
+
+                if stats["pitching"]:
+                    pitching_logs.append(extract_pitching(game_row + (player_id,), stats["pitching"]))
 
     return batting_logs, pitching_logs
 
 
+def compile_extractor(fields, derived=DERIVED_FIELDS):
+
+    # Turn a field table into one flat function, so there's no per-field looping
+    # or dict building when a boxscore is parsed
+    names = {field[0]: "c{}".format(i) for i, field in enumerate(fields)}
+    namespace = {}
+    lines = ["def extract(row, stats):"]
+
+    for i, (col, api_field, col_type, default) in enumerate(fields):
+        if api_field is not None:
+            namespace["t{}".format(i)] = col_type
+            lines.append("    c{0} = t{0}(stats.get({1!r}, {2!r}))".format(i, api_field, default))
+
+    for i, (col, api_field, col_type, default) in enumerate(fields):
+        if api_field is None:
+            lines.append("    c{} = {}".format(i, derived[col].format(**names)))
+
+    lines.append("    return row + ({},)".format(", ".join(names[field[0]] for field in fields)))
+
+    exec("\n".join(lines), namespace)
+    return namespace["extract"]
+
+
+extract_batting = compile_extractor(BATTING_FIELDS)
+extract_pitching = compile_extractor(PITCHING_FIELDS)
+
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
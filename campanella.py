@@ -1,125 +1,76 @@
 import pandas as pd
 from datetime import datetime
 from pathlib import Path
-import sqlite3
+
+import build_logs
+import league_baselines
+import name_register
+import projection_engine
+import weighting
 
 def main():
     project_all("2022-04-01")
 
 
-def project_all(projection_date_str):
-    project(projection_date_str, BATTING, True)
-    project(projection_date_str, PITCHING, False)
+def project_all(projection_date_str, chunk_rows=None, incremental=False, indexed=False):
+    projection_engine.project_all(projection_date_str, [MODEL], chunk_rows, incremental, indexed)
 
 
-def project(projection_date_str, settings, is_batting):
+def project_player(player_id, projection_date_str, is_batting=True):
 
-    MAX_DAYS_AGO = 2000
-    TOP_PA = 725
-    MIN_PA = 400
+    # One player's row of the full projection, from only their rows of the decay index
+    # plus the date's saved league averages and playing time maximums. A date's first
+    # projection looks up everyone once to save those.
+    settings = BATTING if is_batting else PITCHING
+    cols = get_cols(settings, is_batting)
 
-    TOP_BF_SP = 850
-    MIN_BF_SP = 500
-    TOP_BF_RP = 330
-    MIN_BF_RP = 200
+    MAX_DAYS_AGO = projection_engine.MAX_DAYS_AGO
 
-    # Compared to the max appearances, what percentage does a player need to get a projection?
-    APPEARANCE_THRESHOLD = 0.11
+    projection_day = build_logs.date_to_day(projection_date_str)
+    first_day = projection_day - MAX_DAYS_AGO
+    last_day = projection_day - 1
+    lg_avgs = league_baselines.load_baselines(MODEL, settings, is_batting, projection_day, MAX_DAYS_AGO)
 
-    # MLB's "GameTypes"
-    SPRING_TRAINING = "S"
-    EXHIBITION = "E"
-    REGULAR_SEASON = "R"
-    # POST_SEASON = "P"
+    players = [player_id] if lg_avgs is not None else None
+    pr, lg_sums = projection_engine.indexed_sums(MODEL, settings, is_batting, first_day, last_day, projection_day,
+                                                 players, cols)
+    if lg_avgs is None:
+        lg_avgs = league_baselines.save_baselines(MODEL, settings, is_batting, projection_day, MAX_DAYS_AGO, pr, lg_sums)
 
-    # MLB's "SportIDs" for various leagues
-    MLB = 1
-    AAA = 11
-    AA = 12
-    HIGH_A = 13
-    LOW_A = 14
-    ROOKIE = 16
-    FALL = 17
+    pr = finish(pr[pr.index == player_id], lg_avgs, settings, is_batting)
 
-    # Load all player stats
-    df = load_gamelogs(is_batting)
+    # Rounded like the saved projections, so it matches the player's row in them
+    return pr.join(MODEL["load_names"](), how="left").round()
 
-    # Calculate days ago
-    projection_date = datetime.strptime(projection_date_str, "%Y-%m-%d")
-    df["game_date"] = pd.to_datetime(df["game_date"], infer_datetime_format=True)
 
-    df["days_ago"] = (projection_date - df["game_date"]).dt.days
+def finish(pr, lg_avgs, settings, is_batting):
 
-    # Remove data before and after the projection window
-    df = df[df["days_ago"] <= MAX_DAYS_AGO]
-    df = df[df["days_ago"] > 0]
+    TOP_PA = 725
+    MIN_PA = 400
+
+    TOP_BF_SP = 850
+    MIN_BF_SP = 500
+    TOP_BF_RP = 330
+    MIN_BF_RP = 200
 
-    # Setup some initially calculated columns
-    df["UIBB"] = df["BB"] - df["IBB"]
     if is_batting:
-        df["1B"] = df["H"] - df["HR"] - df["3B"] - df["2B"]
-        df["PA"] = df["AB"] + df["BB"] + df["HBP"] + df["SH"] + df["SF"]
         appearances = "PA"
     else:
         appearances = "BFP"
 
-    # Calculate league average before applying weights
-    lg_avg = df[df["league_id"] == MLB]
-    lg_avg = lg_avg[lg_avg["game_type"] == REGULAR_SEASON]
+    # League averages, for the regression
     if is_batting:
-        lg_avg = lg_avg.groupby(["player_id"]).sum()
-        max_pa = lg_avg[appearances].max()
-        lg_avg = lg_avg[lg_avg[appearances] > (max_pa * APPEARANCE_THRESHOLD)]
-        lg_avg = lg_avg.mean()
+        lg_avg = lg_avgs["all"]
     else:
-        lg_avg_sp = lg_avg[lg_avg["GS"] == 1]
-        lg_avg_sp = lg_avg_sp.groupby(["player_id"]).sum()
-        max_pa = lg_avg_sp[appearances].max()
-        lg_avg_sp = lg_avg_sp[lg_avg_sp[appearances] > (max_pa * APPEARANCE_THRESHOLD)]
-        lg_avg_sp = lg_avg_sp.mean()
-
-        lg_avg_rp = lg_avg[lg_avg["GS"] == 0]
-        lg_avg_rp = lg_avg_rp.groupby(["player_id"]).sum()
-        max_pa = lg_avg_rp[appearances].max()
-        lg_avg_rp = lg_avg_rp[lg_avg_rp[appearances] > (max_pa * APPEARANCE_THRESHOLD)]
-        lg_avg_rp = lg_avg_rp.mean()
-
-
-    # Weight stats by decay rate
-    for stat in settings["base_stats"]:
-        df[stat + "_denom"] = df[appearances]
-        df[stat] *= (settings["decay_rates"][stat] ** df["days_ago"]) 
-        df[stat + "_denom"] *= (settings["decay_rates"][stat] ** df["days_ago"])
-
-        # Reduce spring training and exhibition games
-        df.loc[df["game_type"] == SPRING_TRAINING, stat] *= 0.45
-        df.loc[df["game_type"] == SPRING_TRAINING, stat + "_denom"] *= 0.45
-        df.loc[df["game_type"] == EXHIBITION, stat] *= 0.45
-        df.loc[df["game_type"] == EXHIBITION, stat + "_denom"] *= 0.45
-
-        # Reduce minor league stats
-        df.loc[df["league_id"] == AAA, stat] *= settings["aaa_factors"][stat]
-        df.loc[df["league_id"] == AA, stat] *= settings["aa_factors"][stat]
-        df.loc[df["league_id"] == HIGH_A, stat] *= settings["high_a_factors"][stat]
-        df.loc[df["league_id"] == LOW_A, stat] *= settings["low_a_factors"][stat]
-        df.loc[df["league_id"] == ROOKIE, stat] *= settings["rookie_factors"][stat]
-        df.loc[df["league_id"] == FALL, stat] *= settings["fall_factors"][stat]
-
-    # For projected PA/BF, we're only considering MLB regular season
-    df[appearances] *= (settings["decay_rates"][appearances] ** df["days_ago"])
-    df["proj_app"] = df[appearances]
-    df.loc[df["game_type"] != REGULAR_SEASON, "proj_app"] *= 0
-    df.loc[df["league_id"] != MLB, "proj_app"] *= 0
-
-    # Combine a player's daily data into a single row
-    pr = df.groupby(["player_id"]).sum()
+        lg_avg_sp = lg_avgs["sp"]
+        lg_avg_rp = lg_avgs["rp"]
 
     # Cull out players that don't have enough playing time
-    max_pa = pr[appearances].max()
-    pr = pr[pr[appearances] > (max_pa * APPEARANCE_THRESHOLD)]
+    playing_time = lg_avgs["playing_time"]
+    pr = pr[pr[appearances] > (playing_time["max_app"] * APPEARANCE_THRESHOLD)]
 
     if not is_batting:
-        pr["start_pct"] = (pr["GS"] * 5) / ((pr["GS"] * 5) + (pr["G"] - pr["GS"]))
+        pr["start_pct"] = get_start_pct(pr)
 
     # Add league average
     for stat in settings["base_stats"]:
@@ -134,11 +85,11 @@ def project(projection_date_str, settings, is_batting):
 
     # Scale everyone's PA/BF in relation to the top player
     if is_batting:
-        pa_factor = (TOP_PA - MIN_PA) / pr["proj_app"].max()
+        pa_factor = (TOP_PA - MIN_PA) / playing_time["max_proj_app"]
         pr[appearances] = pr["proj_app"] * pa_factor + MIN_PA
     else:
-        pa_factor_sp = (TOP_BF_SP - MIN_BF_SP) / pr["proj_app"].max()
-        pa_factor_rp = (TOP_BF_RP - MIN_BF_RP) / pr.loc[pr["start_pct"] == 0, "proj_app"].max()
+        pa_factor_sp = (TOP_BF_SP - MIN_BF_SP) / playing_time["max_proj_app"]
+        pa_factor_rp = (TOP_BF_RP - MIN_BF_RP) / playing_time["max_proj_app_rp"]
         pr[appearances] = (pr["proj_app"] * pa_factor_sp + MIN_BF_SP) * pr["start_pct"] + (pr["proj_app"] * pa_factor_rp + MIN_BF_RP) * (1 - pr["start_pct"])
 
     # Apply projected rates out to the projected playing time
@@ -160,42 +111,68 @@ def project(projection_date_str, settings, is_batting):
         pr["ER"] = (pr["kwER"] + pr["ER"]) / 2
         pr["R"] = (pr["kwER"] + pr["R"]) / 2
 
-    pr = pr[settings["display_cols"]]
+    return pr[settings["display_cols"]]
+
+
+def get_cols(settings, is_batting):
+    return GAME_COLS + (BATTING_COLS if is_batting else PITCHING_COLS)
+
+
+def playing_time(pr, settings, is_batting):
+
+    # What finish scales playing time against: the most appearances of anyone, then
+    # the most projected appearances of the players left (and of those who only relieve)
+    appearances = "PA" if is_batting else "BFP"
+    max_app = pr[appearances].max()
+    pr = pr[pr[appearances] > (max_app * APPEARANCE_THRESHOLD)]
+
+    values = {"max_app": max_app, "max_proj_app": pr["proj_app"].max()}
+    if not is_batting:
+        values["max_proj_app_rp"] = pr.loc[get_start_pct(pr) == 0, "proj_app"].max()
+
+    return pd.Series(values)
 
-    # Add names to the data for easy readability
-    pr = pr.join(load_names(), how="left")
 
-    save_projection(projection_date_str, pr, is_batting)
+def get_start_pct(pr):
+    return (pr["GS"] * 5) / ((pr["GS"] * 5) + (pr["G"] - pr["GS"]))
 
-def load_gamelogs(is_batting):
-    df = pd.DataFrame()
-    filepath = Path(__file__).parent
 
-    con = sqlite3.connect(filepath / "gamelogs.db")
+def weight_rows(df, settings, is_batting):
 
     if is_batting:
-        df = pd.read_sql_query("SELECT * FROM batting", con)
+        appearances = "PA"
     else:
-        df = pd.read_sql_query("SELECT * FROM pitching", con)
+        appearances = "BFP"
 
-        df["IP"] = df["IP"].map(convert_ip)
+    # Weight stats by decay rate, game type and league, for the whole block of stats at once
+    stats = settings["base_stats"]
+    weights = weighting.compile_weights(settings, stats, projection_engine.MAX_DAYS_AGO)
+    weighted = pd.DataFrame(
+        weighting.weight_stats(weights, df, appearances),
+        index=df.index,
+        columns=stats + [stat + "_denom" for stat in stats],
+    )
+
+    # For projected PA/BF, we're only considering MLB regular season
+    mlb_regular_season = (df["game_type"] == projection_engine.REGULAR_SEASON) & (df["league_id"] == projection_engine.MLB)
+    weighted[appearances] = df[appearances] * (settings["decay_rates"][appearances] ** df["days_ago"])
+    weighted["proj_app"] = weighted[appearances] * mlb_regular_season
 
-    return df
+    return weighted
 
-# Convert IP fractional notation (.1 .2) to true decimals (.33 .67)
-def convert_ip(ip):
-    return int(ip) + (ip % 1 * 10 / 3)
 
+def get_rates(settings, is_batting):
 
-def load_names():
+    # The decay rate of each weighted column
+    appearances = "PA" if is_batting else "BFP"
+    stats = settings["base_stats"]
+    rates = [settings["decay_rates"][stat] for stat in stats] * 2 + [settings["decay_rates"][appearances]] * 2
 
-    names = pd.DataFrame()
-    names = pd.read_csv("https://raw.githubusercontent.com/chadwickbureau/register/master/data/people.csv", low_memory=False)
+    return pd.Series(rates, stats + [stat + "_denom" for stat in stats] + [appearances, "proj_app"])
 
-    names = names[["key_mlbam", "name_last", "name_first"]]
-    names.set_index("key_mlbam", inplace=True)
 
-    return names
+def league_cols(settings, is_batting):
+    return settings["base_stats"] + ["PA" if is_batting else "BFP"]
 
 
 def save_projection(date, df, is_batting):
@@ -250,6 +227,14 @@ def load_player_projections(player_id, is_batting):
 
     return player 
 
+# Compared to the max appearances, what percentage does a player need to get a projection?
+APPEARANCE_THRESHOLD = 0.11
+
+# Columns project() reads from the game logs
+GAME_COLS = ["game_date", "game_type", "league_id", "player_id"]
+BATTING_COLS = ["AB", "R", "H", "2B", "3B", "HR", "RBI", "SB", "CS", "BB", "SO", "IBB", "HBP", "SH", "SF", "GIDP"]
+PITCHING_COLS = ["W", "L", "G", "GS", "CG", "SHO", "QS", "SV", "HLD", "BFP", "H", "ER", "R", "HR", "SO", "BB", "IBB", "HBP", "WP", "BK"]
+
 BATTING = {
     "display_cols": [
         "PA",
@@ -643,6 +628,21 @@ PITCHING = {
     },
 }
 
+MODEL = {
+    "name": "campanella",
+    "batting": BATTING,
+    "pitching": PITCHING,
+    "weight_rows": weight_rows,
+    "get_rates": get_rates,
+    "league_cols": league_cols,
+    "league_threshold": APPEARANCE_THRESHOLD,
+    "get_cols": get_cols,
+    "playing_time": playing_time,
+    "finish": finish,
+    "load_names": name_register.load_names,
+    "save_projection": save_projection,
+}
+
 
 if __name__ == "__main__":
     main()
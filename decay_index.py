@@ -0,0 +1,197 @@
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import gamelog_snapshot
+import projection_state
+
+# Per-player running sums of a model's decayed stats over the whole snapshot, so the
+# sums for any projection date are two lookups per player instead of a scan of its
+# window. Since x * rate ** (T - d) = rate ** (T - base) * (x * rate ** (base - d)), each
+# row holds its player's sums up to and including it, decayed as of base (the first
+# day of its BLOCK_DAYS block), and the sums for rows first_day..last_day as of T are
+#   rate ** (T - base(last)) * sums(last) - rate ** (T - base(before)) * sums(before)
+# for the player's last row on or before last_day and last row before first_day.
+# Re-basing every block keeps rate ** (base - d) small, however long the history.
+BLOCK_DAYS = 365
+
+# Rows are sorted by player, then date, and looked up by player << DAY_BITS | game_date
+DAY_BITS = 20
+
+
+def load_sums(name, is_batting, settings, rates, row_values, cols, first_day, last_day, as_of_day,
+              players=None, snapshot_dir=None):
+
+    # Each player's sums of row_values(df) over game logs from first_day to last_day,
+    # decayed as of as_of_day by rates (a Series of each column's decay rate), for
+    # every player with rows in that window (or just the given players)
+    index = open_index(name, is_batting, settings, rates, row_values, cols, snapshot_dir)
+    return window_sums(index, first_day, last_day, as_of_day, players)
+
+
+def open_index(name, is_batting, settings, rates, row_values, cols, snapshot_dir=None):
+
+    snapshot_dir = Path(snapshot_dir or gamelog_snapshot.SNAPSHOT_DIR)
+    table = "batting" if is_batting else "pitching"
+    index_dir = snapshot_dir / "index" / "{}_{}".format(name, table)
+
+    # An index is for one version of the snapshot and one set of settings
+    fingerprint = projection_state.get_fingerprint(settings, list(rates.items()))
+    version = get_version(gamelog_snapshot.read_current_meta(snapshot_dir, table), fingerprint)
+
+    meta = read_meta(index_dir)
+    if meta is None or meta["version"] != version:
+        with gamelog_snapshot.snapshot_lock(snapshot_dir):
+            # Nothing can update the snapshot while the lock is held, so the index is
+            # built from the snapshot as it is now, without refreshing it again
+            snapshot_meta = gamelog_snapshot.read_meta(snapshot_dir / table)
+            version = get_version(snapshot_meta, fingerprint)
+            meta = read_meta(index_dir)
+            if meta is None or meta["version"] != version:
+                build_index(index_dir, snapshot_dir / table, snapshot_meta, version, rates, row_values, cols)
+                meta = read_meta(index_dir)
+
+    return {
+        "columns": meta["columns"],
+        "rates": np.array(meta["rates"]),
+        "players": np.load(index_dir / "players.npy"),
+        "keys": np.load(index_dir / "keys.npy", mmap_mode="r"),
+        "sums": np.load(index_dir / "sums.npy", mmap_mode="r"),
+    }
+
+
+def get_version(snapshot_meta, fingerprint):
+    return {"rows": snapshot_meta["rows"], "fetched_at": snapshot_meta["fetched_at"], "fingerprint": fingerprint}
+
+
+def build_index(index_dir, table_dir, snapshot_meta, version, rates, row_values, cols):
+
+    # Columns are read straight from the snapshot files, since the caller holds the
+    # snapshot lock (load_gamelogs could try to update the snapshot, and take it again)
+    cols = cols or list(snapshot_meta["columns"])
+    columns = gamelog_snapshot.open_columns(table_dir, snapshot_meta, set(cols) | {"player_id", "game_date"})
+    rows = snapshot_meta["rows"]
+
+    # Rows go from date order (the snapshot's) to player, then date order
+    players, codes = np.unique(np.asarray(columns["player_id"]), return_inverse=True)
+    days = np.asarray(columns["game_date"]).astype("int64")
+    order = np.lexsort((days, codes))
+    codes = codes[order]
+    days = days[order]
+
+    sums = np.empty((rows, len(rates)))
+    for start in range(0, rows, gamelog_snapshot.CHUNK_ROWS):
+        end = min(start + gamelog_snapshot.CHUNK_ROWS, rows)
+        df = pd.DataFrame({column: columns[column][start:end] for column in cols})
+        sums[start:end] = row_values(df)[list(rates.index)].to_numpy()
+    sums = sums[order]
+
+    # Rebase each row to its block, with a lookup table rather than a power per value
+    base = days // BLOCK_DAYS * BLOCK_DAYS
+    rate_values = rates.to_numpy()
+    sums *= (rate_values ** -np.arange(BLOCK_DAYS)[:, None])[days - base]
+    accumulate(sums, codes, base, rate_values)
+
+    tmp_dir = index_dir.with_name(index_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    np.save(tmp_dir / "players.npy", players)
+    np.save(tmp_dir / "keys.npy", (codes.astype("int64") << DAY_BITS) | days)
+    np.save(tmp_dir / "sums.npy", sums)
+    meta = {"version": version, "columns": list(rates.index), "rates": list(rate_values)}
+    (tmp_dir / "meta.json").write_text(json.dumps(meta))
+
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.replace(tmp_dir, index_dir)
+
+
+def accumulate(sums, codes, base, rates):
+
+    # Turns rows of values (already rebased to their block) into running sums, in place.
+    # A run is a player's rows in one block: within a run it's a plain cumulative sum,
+    # on top of everything before the run decayed to the run's base.
+    rows = len(codes)
+    if rows == 0:
+        return
+    new_run = np.ones(rows, bool)
+    new_run[1:] = (codes[1:] != codes[:-1]) | (base[1:] != base[:-1])
+    run_starts = np.flatnonzero(new_run)
+    run_ids = np.cumsum(new_run) - 1
+
+    run_sums = np.add.reduceat(sums, run_starts, axis=0)
+    run_base = base[run_starts]
+    run_codes = codes[run_starts]
+
+    # Carry each player's sums forward a run at a time (players have a run per block at most)
+    new_player = np.ones(len(run_starts), bool)
+    new_player[1:] = run_codes[1:] != run_codes[:-1]
+    first_run = np.maximum.accumulate(np.where(new_player, np.arange(len(run_starts)), 0))
+    run_position = np.arange(len(run_starts)) - first_run
+    carry = np.zeros_like(run_sums)
+    for position in range(1, run_position.max() + 1):
+        runs = np.flatnonzero(run_position == position)
+        decay = rates ** (run_base[runs] - run_base[runs - 1])[:, None]
+        carry[runs] = (carry[runs - 1] + run_sums[runs - 1]) * decay
+
+    # Cumulative sums within runs, a slice of whole runs at a time
+    bounds = run_starts[np.searchsorted(run_starts, np.arange(0, rows, gamelog_snapshot.CHUNK_ROWS))
+                        .clip(max=len(run_starts) - 1)]
+    bounds = np.append(np.unique(bounds), rows)
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        sums[start:end] = pd.DataFrame(sums[start:end]).groupby(run_ids[start:end]).cumsum().to_numpy()
+    sums += carry[run_ids]
+
+
+def window_sums(index, first_day, last_day, as_of_day, players=None):
+
+    keys = index["keys"]
+    if players is None:
+        codes = np.arange(len(index["players"]))
+    else:
+        players = np.asarray(players)
+        codes = np.searchsorted(index["players"], players)
+        known = codes < len(index["players"])
+        known[known] = index["players"][codes[known]] == players[known]
+        codes = codes[known]
+    player_keys = codes.astype("int64") << DAY_BITS
+
+    # Each player's first row, last row in the window and last row before it
+    first_rows = np.searchsorted(keys, player_keys, "left")
+    last_rows = np.searchsorted(keys, player_keys | last_day, "right") - 1
+    before_rows = np.searchsorted(keys, player_keys | (first_day - 1), "right") - 1
+
+    in_window = last_rows > before_rows
+    codes = codes[in_window]
+    last_sums = decayed_sums(index, last_rows[in_window], first_rows[in_window], as_of_day)
+    sums = last_sums - decayed_sums(index, before_rows[in_window], first_rows[in_window], as_of_day)
+
+    # Where the window adds nothing to a column (like GS for a reliever), the two sums
+    # only cancel up to rounding. A scan of the window gives exactly 0, and rates
+    # divided by it are NaN or inf, not garbage.
+    sums[np.abs(sums) <= 1e-9 * np.abs(last_sums)] = 0
+
+    return pd.DataFrame(sums, index=pd.Index(index["players"][codes], name="player_id"), columns=index["columns"])
+
+
+def decayed_sums(index, rows, first_rows, as_of_day):
+
+    # A row's running sums decayed as of as_of_day, or zeros for players with no row yet
+    has_row = rows >= first_rows
+    rows = np.where(has_row, rows, 0)
+    days = np.asarray(index["keys"][rows]) & ((1 << DAY_BITS) - 1)
+    base = days // BLOCK_DAYS * BLOCK_DAYS
+
+    decay = index["rates"] ** (as_of_day - base)[:, None]
+    return np.asarray(index["sums"][rows]) * decay * has_row[:, None]
+
+
+def read_meta(index_dir):
+
+    try:
+        return json.loads((index_dir / "meta.json").read_text())
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,284 @@
+import fcntl
+import json
+import os
+import shutil
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import build_logs
+
+# Columnar copy of the batting and pitching tables for the projection models.
+# Each table is a directory of raw column files plus a meta.json with the row count
+# and dtypes. Rows are sorted by game_date, so a projection window is a contiguous
+# slice. The files are memory mapped, so reading a window only touches its own
+# pages, which stay in the OS cache for the next process. The frames load_gamelogs
+# and iter_gamelogs return are copies of the window's columns, since pandas
+# consolidates them into blocks; iter_gamelogs keeps that copy to a chunk at a time.
+SNAPSHOT_DIR = Path(__file__).parent / "snapshot"
+
+# Rows read from SQLite at a time when (re)building
+CHUNK_ROWS = 250000
+
+# NULLs are stored as 0 (like bench players' batting order), except for these
+NULL_VALUES = {"game_type": -1}
+
+GAME_DTYPES = {
+    "game_date": "int32",
+    "game_id": "int32",
+    "game_type": "int8",
+    "venue_id": "int32",
+    "league_id": "int8",
+    "player_id": "int32",
+}
+BATTING_DTYPES = dict(GAME_DTYPES, batting_order="int16", **{
+    field[0]: "int16" for field in build_logs.BATTING_FIELDS
+})
+PITCHING_DTYPES = dict(GAME_DTYPES, **{
+    field[0]: "int16" for field in build_logs.PITCHING_FIELDS
+})
+
+
+def main():
+    update_snapshot()
+
+
+def update_snapshot(db_path=build_logs.DB_PATH, snapshot_dir=None):
+
+    snapshot_dir = Path(snapshot_dir or SNAPSHOT_DIR)
+    snapshot_dir.mkdir(parents=True, exist_ok=True)
+
+    with snapshot_lock(snapshot_dir):
+        # Older databases are migrated (and get a manifest) before anything is read from them
+        build_logs.setup_db(db_path)
+
+        con = build_logs.connect_db(db_path)
+        try:
+            return {
+                "batting": update_table(con, "batting", BATTING_DTYPES, snapshot_dir),
+                "pitching": update_table(con, "pitching", PITCHING_DTYPES, snapshot_dir),
+            }
+        finally:
+            con.close()
+
+
+def update_table(con, table, dtypes, snapshot_dir):
+
+    table_dir = snapshot_dir / table
+    meta = read_meta(table_dir)
+    if meta is None or meta["schema_version"] != build_logs.SCHEMA_VERSION or meta["columns"] != dtypes:
+        return rebuild_table(con, table, dtypes, table_dir)
+
+    # Everything fetched since the last update, according to the ingestion manifest
+    changed = get_changed_games(con, meta["fetched_at"], meta["fetched_games"])
+    included = set(meta["fetched_games"])
+    if not changed:
+        return "current"
+
+    # New games on or after the last day in the snapshot are appended. Anything
+    # else (late games from earlier dates, reloaded games) means a full rebuild.
+    last_day = meta["last_day"]
+    first_day = min(build_logs.date_to_day(game[1]) for game in changed)
+    if first_day < last_day:
+        return rebuild_table(con, table, dtypes, table_dir)
+
+    columns = open_columns(table_dir, meta, ["game_date", "game_id"])
+    tail = columns["game_id"][np.searchsorted(columns["game_date"], last_day):]
+    if np.isin([game[0] for game in changed], tail).any():
+        return rebuild_table(con, table, dtypes, table_dir)
+
+    con.execute("CREATE TEMP TABLE IF NOT EXISTS snapshot_games (game_id integer PRIMARY KEY)")
+    con.execute("DELETE FROM snapshot_games")
+    con.executemany("INSERT INTO snapshot_games VALUES (?)", [(game[0],) for game in changed])
+    query = '''SELECT {} FROM {} WHERE game_id IN (SELECT game_id FROM snapshot_games)
+               ORDER BY game_date, game_id, player_id'''.format(select_cols(dtypes), table)
+
+    for column, path in column_paths(table_dir, dtypes).items():
+        # Drop anything past the recorded row count, left by an interrupted append
+        with open(path, "r+b") as f:
+            f.truncate(meta["rows"] * np.dtype(dtypes[column]).itemsize)
+
+    rows, new_last_day = write_chunks(con, query, dtypes, table_dir, "ab")
+    fetched = changed + [(game_id, None, meta["fetched_at"]) for game_id in included]
+    write_meta(table_dir, dtypes, meta["rows"] + rows, max(last_day, new_last_day), fetched)
+
+    return "appended"
+
+
+def get_changed_games(con, fetched_at, fetched_games):
+
+    # Games in the manifest stamped at or after fetched_at, as (game_id, game_date, fetched_at).
+    # Games stamped in that same second are left out if they're in fetched_games.
+    changed = con.execute('''SELECT game_id, game_date, COALESCE(fetched_at, '') FROM ingested_games
+                          WHERE COALESCE(fetched_at, '') >= ?''', (fetched_at,)).fetchall()
+    included = set(fetched_games)
+
+    return [game for game in changed if not (game[2] == fetched_at and game[0] in included)]
+
+
+def rebuild_table(con, table, dtypes, table_dir):
+
+    # Built next to the live snapshot and swapped in, so readers never see half of one.
+    # Processes that already mapped the old files keep reading them until they're done.
+    tmp_dir = table_dir.with_name(table_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
+    # The manifest is read first, so every game it lists is in the rows read after it
+    fetched = con.execute("SELECT game_id, game_date, COALESCE(fetched_at, '') FROM ingested_games").fetchall()
+
+    query = "SELECT {} FROM {} ORDER BY game_date, game_id, player_id".format(select_cols(dtypes), table)
+    rows, last_day = write_chunks(con, query, dtypes, tmp_dir, "wb")
+    write_meta(tmp_dir, dtypes, rows, last_day, fetched)
+
+    old_dir = table_dir.with_name(table_dir.name + ".old")
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if table_dir.exists():
+        os.replace(table_dir, old_dir)
+    os.replace(tmp_dir, table_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+    return "rebuilt"
+
+
+def write_chunks(con, query, dtypes, table_dir, mode):
+
+    paths = column_paths(table_dir, dtypes)
+    files = {column: open(path, mode) for column, path in paths.items()}
+    rows = 0
+    last_day = -1
+    try:
+        for chunk in pd.read_sql_query(query, con, chunksize=CHUNK_ROWS):
+            for column, dtype in dtypes.items():
+                values = chunk[column].fillna(NULL_VALUES.get(column, 0))
+                files[column].write(values.to_numpy(dtype).tobytes())
+            rows += len(chunk)
+            last_day = int(chunk["game_date"].iloc[-1])
+    finally:
+        for f in files.values():
+            f.close()
+
+    return rows, last_day
+
+
+def write_meta(table_dir, dtypes, rows, last_day, fetched):
+
+    # Remember the newest manifest stamp covered, and which games carry it
+    fetched_at = max((game[2] for game in fetched), default="")
+    meta = {
+        "schema_version": build_logs.SCHEMA_VERSION,
+        "rows": rows,
+        "last_day": last_day,
+        "fetched_at": fetched_at,
+        "fetched_games": [game[0] for game in fetched if game[2] == fetched_at],
+        "columns": dtypes,
+    }
+
+    # The row count is only published once the column files are complete
+    tmp_path = table_dir / "meta.json.tmp"
+    tmp_path.write_text(json.dumps(meta))
+    os.replace(tmp_path, table_dir / "meta.json")
+
+
+def load_gamelogs(is_batting, first_day=None, last_day=None, cols=None, snapshot_dir=None):
+
+    columns, start, end = open_window(is_batting, first_day, last_day, cols, snapshot_dir)
+    return pd.DataFrame({column: values[start:end] for column, values in columns.items()})
+
+
+def iter_gamelogs(is_batting, first_day=None, last_day=None, cols=None, chunk_rows=None, snapshot_dir=None):
+
+    # Same rows as load_gamelogs, as a frame of at most chunk_rows rows at a time
+    columns, start, end = open_window(is_batting, first_day, last_day, cols, snapshot_dir)
+    chunk_rows = chunk_rows or max(end - start, 1)
+
+    # An empty window still gives one (empty) frame
+    for chunk_start in range(start, max(end, start + 1), chunk_rows):
+        chunk_end = min(chunk_start + chunk_rows, end)
+        yield pd.DataFrame({column: values[chunk_start:chunk_end] for column, values in columns.items()})
+
+
+def open_window(is_batting, first_day, last_day, cols, snapshot_dir):
+
+    snapshot_dir = Path(snapshot_dir or SNAPSHOT_DIR)
+    table_dir = snapshot_dir / ("batting" if is_batting else "pitching")
+    meta = read_current_meta(snapshot_dir, "batting" if is_batting else "pitching")
+
+    cols = cols or list(meta["columns"])
+    columns = open_columns(table_dir, meta, set(cols) | {"game_date"})
+
+    # Rows are in date order, so the window [first_day, last_day] is one slice
+    dates = columns["game_date"]
+    start = np.searchsorted(dates, first_day, "left") if first_day is not None else 0
+    end = np.searchsorted(dates, last_day, "right") if last_day is not None else meta["rows"]
+
+    return {column: columns[column] for column in cols}, int(start), int(end)
+
+
+def open_columns(table_dir, meta, cols):
+
+    paths = column_paths(table_dir, meta["columns"])
+    columns = {}
+    for column in cols:
+        dtype = meta["columns"][column]
+        if meta["rows"] == 0:
+            columns[column] = np.empty(0, dtype)
+        else:
+            columns[column] = np.memmap(paths[column], dtype, "r", shape=(meta["rows"],))
+
+    return columns
+
+
+def read_current_meta(snapshot_dir, table, db_path=build_logs.DB_PATH):
+
+    # The table's meta, once the snapshot has caught up with whatever was ingested since
+    # it was last updated. Anything that writes game logs (daily builds, shard merges,
+    # retries, imports) stamps the manifest, so none of them can leave it stale.
+    meta = read_meta(snapshot_dir / table)
+    if meta is not None:
+        con = build_logs.connect_db(db_path)
+        try:
+            version = con.execute("PRAGMA user_version").fetchone()[0]
+            changed = version < build_logs.SCHEMA_VERSION or get_changed_games(
+                con, meta["fetched_at"], meta["fetched_games"])
+        finally:
+            con.close()
+        if not changed:
+            return meta
+
+    update_snapshot(db_path, snapshot_dir)
+    return read_meta(snapshot_dir / table)
+
+
+def read_meta(table_dir):
+
+    try:
+        return json.loads((table_dir / "meta.json").read_text())
+    except FileNotFoundError:
+        return None
+
+
+def column_paths(table_dir, dtypes):
+    return {column: table_dir / "{}.bin".format(column) for column in dtypes}
+
+
+def select_cols(dtypes):
+    return ", ".join('"{}"'.format(column) for column in dtypes)
+
+
+@contextmanager
+def snapshot_lock(snapshot_dir):
+
+    # Only one process updates the snapshot at a time
+    with open(snapshot_dir / ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+if __name__ == "__main__":
+    main()
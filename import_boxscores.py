@@ -0,0 +1,199 @@
+import argparse
+import gzip
+import logging
+import os
+import re
+import tarfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+import build_logs
+import gamelog_snapshot
+import ingest_metrics
+
+# Seeds gamelogs.db from archived Stats API responses instead of the network.
+# An archive is a directory or tarball of JSON files, optionally gzipped:
+#   .../schedule/<sportId>*.json  - schedule responses ({"dates": [...]}). Their games say which
+#                                   date, type, venue and league each boxscore belongs to.
+#   .../boxscore/<gamePk>*.json   - boxscore responses, named after their game
+# A file with "sportId=<n>" in its path is also read as a schedule for that league,
+# so responses saved straight from the schedule URL work as well.
+# The fixtures recorded by statsapi_stub are laid out this way already.
+
+# Boxscores handed to a worker process at a time
+FILES_PER_TASK = 64
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Load archived boxscores into gamelogs.db")
+    parser.add_argument("archive", help="directory or tarball of schedule and boxscore JSON")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--db", default=str(build_logs.DB_PATH))
+    parser.add_argument("--force", action="store_true", help="reload games that are already in the database")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    import_boxscores(args.archive, processes=args.processes, db_path=args.db, force=args.force)
+    gamelog_snapshot.update_snapshot(args.db)
+
+
+def import_boxscores(archive, processes=None, batch_games=build_logs.BATCH_GAMES,
+                     db_path=build_logs.DB_PATH, force=False):
+
+    archive = Path(archive)
+    processes = processes or os.cpu_count()
+
+    ingest_metrics.start()
+    metrics = ingest_metrics.current()
+
+    build_logs.setup_db(db_path)
+    con = build_logs.connect_db(db_path)
+    writer = build_logs.GamelogWriter(con, batch_games)
+    loaded = set() if force else build_logs.get_loaded_games(con)
+
+    completed = False
+    try:
+        # The schedules come first, since a boxscore alone doesn't say when or where it was played
+        schedules = []
+        for name, content in read_archive(archive, schedules=True):
+            sportId = get_sport_id(name)
+            if sportId is None:
+                ingest_metrics.emit("schedule_skipped", logging.WARNING, file=name, error="no sportId in path")
+                continue
+            schedules.append(build_logs.parse_schedule(build_logs.decode_json(decompress(content)), sportId))
+        games = {game["game_id"]: game for game in build_logs.select_games(schedules)}
+        metrics.count("games_discovered", len(games))
+
+        # Then the boxscores are parsed across processes and written here, in batches
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            pending = set()
+            for task in get_tasks(archive, games, loaded, metrics):
+                pending.add(executor.submit(parse_files, task))
+
+                # Only a few tasks are queued at once, so a large tarball isn't read into memory
+                if len(pending) >= processes * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    write_results(writer, done, metrics)
+
+            done, pending = wait(pending)
+            write_results(writer, done, metrics)
+
+        writer.flush()
+        build_logs.analyze_db(con, bulk=True)
+        completed = True
+    finally:
+        con.close()
+
+        summary = metrics.summary()
+        summary["archive"] = str(archive)
+        summary["completed"] = completed
+        ingest_metrics.emit("import_summary", **summary)
+
+    return summary
+
+
+def get_tasks(archive, games, loaded, metrics):
+
+    task = []
+    for name, content in read_archive(archive, schedules=False):
+        game_id = get_game_id(name)
+        game = games.get(game_id)
+        if game is None:
+            metrics.count("boxscores_unscheduled")
+            continue
+        if game_id in loaded:
+            metrics.count("games_skipped")
+            continue
+
+        # Directories are read by the workers; tarball members have to be read here
+        task.append((game, name, content))
+        if len(task) >= FILES_PER_TASK:
+            yield task
+            task = []
+
+    if task:
+        yield task
+
+
+def parse_files(task):
+
+    # Runs in a worker process: the same extraction as get_game_logs, minus the request
+    results = []
+    for game, name, content in task:
+        try:
+            if content is None:
+                content = Path(name).read_bytes()
+            game_info = build_logs.decode_json(decompress(content))
+            results.append((game, build_logs.parse_game_logs(game, game_info), None))
+        except Exception as error:
+            results.append((game, None, error))
+
+    return results
+
+
+def write_results(writer, done, metrics):
+
+    for future in done:
+        for game, game_logs, error in future.result():
+            if error:
+                ingest_metrics.emit("game_failed", logging.WARNING, game_id=game["game_id"], error=repr(error))
+                metrics.count("games_failed")
+                writer.fail(game, error)
+            else:
+                metrics.count("games_fetched")
+                writer.add(game, *game_logs)
+
+
+def read_archive(archive, schedules):
+
+    # Yields (name, content) for the schedule or boxscore files in the archive.
+    # Files in a directory are left for the caller to read, as content None.
+    if archive.is_dir():
+        for path in sorted(archive.rglob("*")):
+            if path.is_file() and is_json(path.name) and is_schedule(str(path.relative_to(archive))) == schedules:
+                if schedules:
+                    yield str(path), path.read_bytes()
+                else:
+                    yield str(path), None
+    else:
+        with tarfile.open(archive, "r:*") as tar:
+            for member in tar:
+                if member.isfile() and is_json(member.name) and is_schedule(member.name) == schedules:
+                    yield member.name, tar.extractfile(member).read()
+
+
+def is_json(name):
+    return name.endswith(".json") or name.endswith(".json.gz")
+
+
+def is_schedule(name):
+    return "schedule" in Path(name).parts[:-1] or "sportId=" in name
+
+
+def get_sport_id(name):
+
+    match = re.search(r"sportId=(\d+)", name)
+    if match:
+        return int(match.group(1))
+
+    match = re.match(r"\d+", Path(name).name)
+    return int(match.group()) if match else None
+
+
+def get_game_id(name):
+
+    numbers = re.findall(r"\d+", Path(name).name)
+    return int(numbers[0]) if numbers else None
+
+
+def decompress(content):
+
+    # Gzipped files are recognized by their magic number rather than their name
+    if content[:2] == b"\x1f\x8b":
+        return gzip.decompress(content)
+    return content
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import contextvars
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger("build_logs")
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float("inf")]
+
+
+class IngestMetrics:
+
+    # Counters and per-phase latency histograms for one build. Safe to update
+    # from the executor threads doing the fetching and parsing.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.counters = defaultdict(int)
+        self.phases = {}
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    @contextmanager
+    def timed(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - start)
+
+    def observe(self, phase, seconds):
+        with self.lock:
+            if phase not in self.phases:
+                self.phases[phase] = {"count": 0, "total": 0.0, "max": 0.0, "buckets": [0] * len(LATENCY_BUCKETS)}
+            stats = self.phases[phase]
+            stats["count"] += 1
+            stats["total"] += seconds
+            stats["max"] = max(stats["max"], seconds)
+            stats["buckets"][next(i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound)] += 1
+
+    def summary(self):
+        with self.lock:
+            phases = {}
+            for phase, stats in self.phases.items():
+                phases[phase] = {
+                    "count": stats["count"],
+                    "total": round(stats["total"], 4),
+                    "mean": round(stats["total"] / stats["count"], 4),
+                    "p50": percentile(stats, 0.5),
+                    "p95": percentile(stats, 0.95),
+                    "max": round(stats["max"], 4),
+                    "histogram": {
+                        str(bound): count for bound, count in zip(LATENCY_BUCKETS, stats["buckets"]) if count
+                    },
+                }
+
+            return {
+                "elapsed": round(time.monotonic() - self.started, 4),
+                "counters": dict(self.counters),
+                "phases": phases,
+            }
+
+
+def percentile(stats, fraction):
+
+    # Upper bound of the bucket the percentile falls in
+    target = stats["count"] * fraction
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS, stats["buckets"]):
+        seen += count
+        if seen >= target:
+            return bound if bound != float("inf") else round(stats["max"], 4)
+
+    return round(stats["max"], 4)
+
+
+# Builds each get their own metrics; anything outside a build records into a throwaway one
+current_metrics = contextvars.ContextVar("current_metrics", default=IngestMetrics())
+
+
+def current():
+    return current_metrics.get()
+
+
+def start():
+    return current_metrics.set(IngestMetrics())
+
+
+def emit(event, level=logging.INFO, **fields):
+
+    # One JSON object per line, so the logs can be parsed as well as read
+    if logger.isEnabledFor(level):
+        logger.log(level, json.dumps(dict(event=event, **fields), default=str))
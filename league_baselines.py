@@ -0,0 +1,131 @@
+import json
+from pathlib import Path
+
+import pandas as pd
+
+import build_logs
+import gamelog_snapshot
+import projection_state
+
+# League averages each model regresses players toward, kept in gamelogs.db by model,
+# side, projection date and role ("all" for batters, "sp"/"rp" for pitchers), so a
+# projection only sums up the league's game logs the first time a date is projected.
+# Models that scale playing time to the league's leaders keep those maximums here too,
+# as the "playing_time" role, so one player can be projected without the rest.
+# A date's baselines are recomputed when its settings change, or when games inside
+# its window (the max_days_ago days before the date) were fetched after they were saved.
+# They're computed the first time a date is projected, not as game logs are ingested:
+# the league sums come from whichever sums the projection has (advanced from the saved
+# projection_state in incremental runs, looked up in the decay index in indexed ones,
+# a scan otherwise), so a new date costs no more than its projection already does.
+# What they save is the work of later projections of the same date: reruns,
+# project_player and the other models run on it.
+
+
+def load_baselines(model, settings, is_batting, projection_day, max_days_ago, db_path=build_logs.DB_PATH):
+
+    # {role: league average} for the date, or None when they have to be (re)computed.
+    # Models without league averages have none to compute.
+    if not has_baselines(model, settings, is_batting):
+        return {}
+
+    con = connect_db(db_path)
+    try:
+        row = con.execute('''SELECT fingerprint, fetched_at, fetched_games FROM league_baseline_dates
+                             WHERE model = ? AND side = ? AND projection_date = ?''',
+                          (model["name"], get_side(is_batting), build_logs.day_to_date(projection_day))).fetchone()
+        if row is None or row[0] != get_fingerprint(model, settings, max_days_ago):
+            return None
+
+        changed = gamelog_snapshot.get_changed_games(con, row[1], json.loads(row[2]))
+        first_day = projection_day - max_days_ago
+        if any(first_day <= build_logs.date_to_day(game[1]) < projection_day for game in changed):
+            return None
+
+        baselines = pd.read_sql_query('''SELECT role, stat, value FROM league_baselines
+                                         WHERE model = ? AND side = ? AND projection_date = ?''', con,
+                                      params=(model["name"], get_side(is_batting), build_logs.day_to_date(projection_day)))
+    finally:
+        con.close()
+
+    # Baselines of an empty window (or role) are NaN, which SQLite keeps as NULL
+    return {role: rows.set_index("stat")["value"].rename(None).astype(float) for role, rows in baselines.groupby("role")}
+
+
+def save_baselines(model, settings, is_batting, projection_day, max_days_ago, pr, lg_sums,
+                   db_path=build_logs.DB_PATH, snapshot_dir=None):
+
+    # Turn each role's per-player league sums into its average, and keep them along
+    # with the playing time the model scales to (from its per-player sums, pr)
+    if not has_baselines(model, settings, is_batting):
+        return {}
+
+    lg_cols = model["league_cols"](settings, is_batting)
+    appearances = "PA" if is_batting else "BFP"
+    baselines = {
+        role: league_average(sums[lg_cols], appearances, model["league_threshold"])
+        for role, sums in lg_sums.items()
+    }
+    if "playing_time" in model:
+        baselines["playing_time"] = model["playing_time"](pr, settings, is_batting)
+
+    # Stamped with the snapshot the sums came from
+    side = get_side(is_batting)
+    meta = gamelog_snapshot.read_meta(Path(snapshot_dir or gamelog_snapshot.SNAPSHOT_DIR) / side) or {}
+    projection_date = build_logs.day_to_date(projection_day)
+    key = (model["name"], side, projection_date)
+
+    con = connect_db(db_path)
+    try:
+        with con:
+            con.execute("DELETE FROM league_baselines WHERE model = ? AND side = ? AND projection_date = ?", key)
+            con.executemany(
+                "INSERT INTO league_baselines VALUES (?, ?, ?, ?, ?, ?)",
+                [key + (role, stat, float(value)) for role, averages in baselines.items() for stat, value in averages.items()],
+            )
+            con.execute("INSERT OR REPLACE INTO league_baseline_dates VALUES (?, ?, ?, ?, ?, ?)", key + (
+                get_fingerprint(model, settings, max_days_ago),
+                meta.get("fetched_at", ""),
+                json.dumps(meta.get("fetched_games", [])),
+            ))
+    finally:
+        con.close()
+
+    return baselines
+
+
+def league_average(lg_avg, appearances, threshold):
+
+    # Average of the MLB players with enough playing time
+    max_pa = lg_avg[appearances].max()
+    lg_avg = lg_avg[lg_avg[appearances] > (max_pa * threshold)]
+
+    return lg_avg.mean()
+
+
+def connect_db(db_path):
+
+    con = build_logs.connect_db(db_path)
+    con.execute('''CREATE TABLE IF NOT EXISTS league_baseline_dates (
+                       model text, side text, projection_date text,
+                       fingerprint text, fetched_at text, fetched_games text,
+                       PRIMARY KEY (model, side, projection_date))''')
+    con.execute('''CREATE TABLE IF NOT EXISTS league_baselines (
+                       model text, side text, projection_date text, role text, stat text, value real,
+                       PRIMARY KEY (model, side, projection_date, role, stat))''')
+
+    return con
+
+
+def has_baselines(model, settings, is_batting):
+    return bool(model["league_cols"](settings, is_batting)) or "playing_time" in model
+
+
+def get_fingerprint(model, settings, max_days_ago):
+
+    # The playing time maximums are weighted, so baselines go with all of the settings
+    return projection_state.get_fingerprint([settings, model.get("league_threshold")], max_days_ago)
+
+
+def get_side(is_batting):
+    return "batting" if is_batting else "pitching"
@@ -2,14 +2,19 @@ from flask import Flask, Response, redirect, request, render_template
 
 import pandas as pd
 import json
+import logging
 from datetime import datetime
 
 import build_logs
+import gamelog_snapshot
 import blyleven as project2
 import campanella as project3
 
 app = Flask(__name__, static_folder="assets")
 
+# Ingestion reports its progress and a summary of each build as JSON log lines
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -17,17 +22,20 @@ def index():
 @app.route('/stats/<int:year>', methods=['PUT'])
 def put_year_stats(year):
     build_logs.build_yearly_gamelogs(year)
+    gamelog_snapshot.update_snapshot()
     return "Built logs for " + str(year)
 
 @app.route('/stats/<int:year>/<int:month>', methods=['PUT'])
 def put_month_stats(year, month):
     build_logs.build_monthly_gamelogs(year, month)
+    gamelog_snapshot.update_snapshot()
     return "Built logs for " + str(year) + "-" + str(month)
 
 @app.route('/stats/<int:year>/<int:month>/<int:day>', methods=['PUT'])
 def put_day_stats(year, month, day):
     date_string = str(year) + "-" + str(month).zfill(2) + "-" + str(day).zfill(2)
     build_logs.build_daily_gamelogs(date_string)
+    gamelog_snapshot.update_snapshot()
     return "Built logs for " + date_string
 
 @app.route('/projections/<string:date_string>', methods=['PUT'])
@@ -86,7 +94,12 @@ def get_projections(date_string):
 
 @app.route('/v3/projections/<string:date_string>', methods=['PUT'])
 def put_v3_projections(date_string):
-    project3.project_all(date_string)
+    # Daily runs pick up from the saved sums of the last run instead of the whole window.
+    # Past dates are looked up in the decay index, leaving the daily sums alone.
+    if date_string < datetime.today().strftime("%Y-%m-%d"):
+        project3.project_all(date_string, indexed=True)
+    else:
+        project3.project_all(date_string, incremental=True)
     return "Projections for " + date_string + " finished"
 
 @app.route('/v3/projections/<string:date_string>', methods=['GET'])
@@ -0,0 +1,129 @@
+import logging
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+import pandas as pd
+import requests
+
+# Slim local copy of the Chadwick Bureau register: just the MLBAM id and name of
+# every player, in a small SQLite table keyed by key_mlbam. It's downloaded again
+# when it's older than REGISTER_TTL (and only if the file changed, going by its ETag),
+# and the last copy keeps being used when GitHub can't be reached.
+PEOPLE_URL = "https://raw.githubusercontent.com/chadwickbureau/register/master/data/people.csv"
+REGISTER_PATH = Path(__file__).parent / "cache" / "names.db"
+REGISTER_TTL = 7 * 24 * 60 * 60
+REQUEST_TIMEOUT = 60
+
+logger = logging.getLogger("name_register")
+
+# Names already read in this process, and when, for each register file
+loaded = {}
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    print(refresh_register(force=True))
+
+
+def load_names(register_path=None):
+
+    register_path = Path(register_path or REGISTER_PATH)
+
+    # Each process reads the register once, and checks it again after the TTL
+    names, loaded_at = loaded.get(register_path, (None, 0.0))
+    if names is None or time.time() - loaded_at > REGISTER_TTL:
+        refresh_register(register_path)
+        names = read_register(register_path)
+        loaded[register_path] = (names, time.time())
+
+    return names
+
+
+def refresh_register(register_path=None, force=False):
+
+    register_path = Path(register_path or REGISTER_PATH)
+    etag, fetched_at = read_meta(register_path)
+    if not force and fetched_at and time.time() - fetched_at < REGISTER_TTL:
+        return "current"
+
+    headers = {"If-None-Match": etag} if etag else {}
+    try:
+        response = requests.get(PEOPLE_URL, headers=headers, timeout=REQUEST_TIMEOUT, stream=True)
+        if response.status_code == 304:
+            write_meta(register_path, etag)
+            return "not modified"
+        response.raise_for_status()
+
+        # Only the columns we keep are parsed, straight off the wire
+        response.raw.decode_content = True
+        names = pd.read_csv(response.raw, usecols=["key_mlbam", "name_last", "name_first"])
+    except (requests.RequestException, ValueError) as error:
+        if register_path.exists():
+            logger.warning("Couldn't refresh the name register (%r), using the local copy", error)
+            return "offline"
+        logger.warning("Couldn't download the name register (%r), projections won't have names", error)
+        return "unavailable"
+
+    names = names.dropna(subset=["key_mlbam"])
+    names["key_mlbam"] = names["key_mlbam"].astype("int64")
+    write_register(register_path, names.drop_duplicates("key_mlbam"), response.headers.get("ETag"))
+
+    return "downloaded"
+
+
+def read_register(register_path):
+
+    if not register_path.exists():
+        names = pd.DataFrame(columns=["key_mlbam", "name_last", "name_first"])
+    else:
+        con = sqlite3.connect(register_path)
+        names = pd.read_sql_query("SELECT key_mlbam, name_last, name_first FROM names", con)
+        con.close()
+
+    names.set_index("key_mlbam", inplace=True)
+    return names
+
+
+def write_register(register_path, names, etag):
+
+    # Written to a new file and swapped in, so readers always see a whole register
+    register_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = register_path.with_name("{}.{}.tmp".format(register_path.name, os.getpid()))
+    if tmp_path.exists():
+        tmp_path.unlink()
+
+    con = sqlite3.connect(tmp_path)
+    con.execute("CREATE TABLE names (key_mlbam integer PRIMARY KEY, name_last text, name_first text)")
+    con.execute("CREATE TABLE meta (etag text, fetched_at real)")
+    con.executemany("INSERT INTO names VALUES (?, ?, ?)", names.itertuples(index=False, name=None))
+    con.execute("INSERT INTO meta VALUES (?, ?)", (etag, time.time()))
+    con.commit()
+    con.close()
+
+    os.replace(tmp_path, register_path)
+
+
+def read_meta(register_path):
+
+    if not register_path.exists():
+        return None, None
+
+    con = sqlite3.connect(register_path)
+    row = con.execute("SELECT etag, fetched_at FROM meta").fetchone()
+    con.close()
+
+    return row if row else (None, None)
+
+
+def write_meta(register_path, etag):
+
+    con = sqlite3.connect(register_path)
+    with con:
+        con.execute("UPDATE meta SET etag = ?, fetched_at = ?", (etag, time.time()))
+    con.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+import pandas as pd
+
+import build_logs
+import decay_index
+import gamelog_snapshot
+import league_baselines
+import projection_state
+
+# Shared steps of the projection models. Every model reads the same window of game
+# logs, weights them and sums them up by player; they differ in their settings and in
+# what they do with those sums. A model is a dict of:
+#   name                                   - its name, for its decay index and saved sums
+#   batting, pitching                      - its settings for each side
+#   get_cols(settings, is_batting)         - optionally, the only game log columns it reads
+#   weight_rows(df, settings, is_batting)  - the weighted columns for each game log row,
+#                                            decayed by df["days_ago"]
+#   get_rates(settings, is_batting)        - the decay rate of each of those columns
+#   league_cols(settings, is_batting)      - the stats behind its league averages, if any
+#   league_threshold                       - the share of the most playing time a player
+#                                            needs to count toward them (with league_cols)
+#   playing_time(pr, settings, is_batting) - optionally, the league-wide playing time its
+#                                            scaling is relative to, from the per-player sums
+#   finish(pr, lg_avgs, settings, is_batting) - a projection from the per-player sums and
+#                                            league averages (see league_baselines)
+#   load_names(), save_projection(date, df, is_batting)
+# so one run can load and prepare the game logs once and project every model from them.
+MAX_DAYS_AGO = 2000
+
+# MLB's "GameTypes", as stored in the game logs
+REGULAR_SEASON = build_logs.GAME_TYPE_CODES["R"]
+# POST_SEASON = build_logs.GAME_TYPE_CODES["P"]
+
+# MLB's "SportID" for the majors (the minor league factors are in weighting.LEAGUE_FACTORS)
+MLB = 1
+
+
+def main():
+    import aparicio
+    import blyleven
+    import campanella
+
+    project_all("2021-07-01", [aparicio.MODEL, blyleven.MODEL, campanella.MODEL])
+
+
+def project_all(projection_date_str, models, chunk_rows=None, incremental=False, indexed=False):
+    project(projection_date_str, models, True, chunk_rows, incremental, indexed)
+    project(projection_date_str, models, False, chunk_rows, incremental, indexed)
+
+
+def project_range(start_date_str, end_date_str, models, step=1):
+
+    # Projections for every step days from the start date through the end date. The
+    # window sums for each date are looked up in the decay index, built once for the range.
+    for projection_date_str in build_logs.get_range_dates(start_date_str, end_date_str, step):
+        project_all(projection_date_str, models, indexed=True)
+
+
+def project(projection_date_str, models, is_batting, chunk_rows=None, incremental=False, indexed=False):
+
+    # Every model's projection for one side. Plain runs read the projection window once
+    # for all of them (a chunk at a time, with chunk_rows). Incremental runs start from
+    # each model's saved sums of an earlier date and only weight the game logs since
+    # then; indexed runs look them up in the running sums of the whole snapshot. League
+    # averages are only summed up for models that don't have them saved for this date.
+    projection_day = build_logs.date_to_day(projection_date_str)
+    first_day = projection_day - MAX_DAYS_AGO
+    last_day = projection_day - 1
+
+    lg_avgs = {
+        model["name"]: league_baselines.load_baselines(
+            model, get_settings(model, is_batting), is_batting, projection_day, MAX_DAYS_AGO)
+        for model in models
+    }
+    if not (indexed or incremental):
+        league = {name: avgs is None for name, avgs in lg_avgs.items()}
+        scanned = aggregate_logs(models, is_batting, first_day, last_day, projection_day, chunk_rows,
+                                 get_cols(models, is_batting), league)
+
+    for model in models:
+        settings = get_settings(model, is_batting)
+        if indexed:
+            pr, lg_sums = indexed_sums(model, settings, is_batting, first_day, last_day, projection_day,
+                                       cols=get_cols([model], is_batting))
+        elif incremental:
+            pr, lg_sums = state_sums(model, settings, is_batting, projection_day, chunk_rows)
+        else:
+            pr, lg_sums = scanned[model["name"]]
+
+        model_lg_avgs = lg_avgs[model["name"]]
+        if model_lg_avgs is None:
+            model_lg_avgs = league_baselines.save_baselines(model, settings, is_batting, projection_day, MAX_DAYS_AGO,
+                                                            pr, lg_sums)
+
+        pr = model["finish"](pr, model_lg_avgs, settings, is_batting)
+        save_projection(model, projection_date_str, pr, is_batting)
+
+
+def save_projection(model, projection_date_str, pr, is_batting):
+
+    # Add names to the data for easy readability
+    pr = pr.join(model["load_names"](), how="left")
+    model["save_projection"](projection_date_str, pr, is_batting)
+
+
+def get_settings(model, is_batting):
+    return model["batting"] if is_batting else model["pitching"]
+
+
+def get_cols(models, is_batting):
+
+    # The game log columns the models read, or all of them if any model doesn't say
+    cols = []
+    for model in models:
+        if "get_cols" not in model:
+            return None
+        cols += model["get_cols"](get_settings(model, is_batting), is_batting)
+
+    return list(dict.fromkeys(cols))
+
+
+def prepare_logs(df, is_batting, projection_day):
+
+    # Calculate days ago (game dates are stored as day numbers). Without a projection
+    # day, rows are weighted as of their own day, which is how the decay index keeps them.
+    df["days_ago"] = projection_day - df["game_date"] if projection_day is not None else 0
+
+    # Setup some initially calculated columns
+    df["UIBB"] = df["BB"] - df["IBB"]
+    if is_batting:
+        df["1B"] = df["H"] - df["HR"] - df["3B"] - df["2B"]
+        df["PA"] = df["AB"] + df["BB"] + df["HBP"] + df["SH"] + df["SF"]
+    elif "outs" in df.columns:
+        # Innings are stored as outs
+        df["IP"] = df["outs"] / 3
+
+
+def weight_logs(model, df, settings, is_batting, league=True):
+
+    # Combine a player's daily data into a single row, and sum up MLB regular season
+    # stats for the league averages without the weights (unless they're already saved)
+    pr = model["weight_rows"](df, settings, is_batting).groupby(df["player_id"]).sum()
+
+    lg_cols = model["league_cols"](settings, is_batting)
+    lg_sums = {}
+    if lg_cols and league:
+        for role, mask in league_masks(df, is_batting).items():
+            lg_sums[role] = df.loc[mask, lg_cols].groupby(df.loc[mask, "player_id"]).sum()
+
+    return pr, lg_sums
+
+
+def aggregate_logs(models, is_batting, first_day, last_day, projection_day, chunk_rows=None, cols=None,
+                   league=None):
+
+    # The same sums as weight_logs for each model (by name) over first_day to last_day, a
+    # chunk of game logs at a time (or all at once, without chunk_rows), so only per-player
+    # sums are kept. Models that league maps to False skip their league sums.
+    sums = {model["name"]: (None, {}) for model in models}
+    for df in gamelog_snapshot.iter_gamelogs(is_batting, first_day, last_day, cols, chunk_rows):
+        prepare_logs(df, is_batting, projection_day)
+
+        for model in models:
+            pr, lg_sums = sums[model["name"]]
+            chunk_pr, chunk_lg_sums = weight_logs(model, df, get_settings(model, is_batting), is_batting,
+                                                  (league or {}).get(model["name"], True))
+            for role, role_sums in chunk_lg_sums.items():
+                lg_sums[role] = add_sums(lg_sums.get(role), role_sums)
+            sums[model["name"]] = (add_sums(pr, chunk_pr), lg_sums)
+
+    return sums
+
+
+def state_sums(model, settings, is_batting, projection_day, chunk_rows=None):
+
+    # The model's sums for projection_day, advanced from its saved sums of an earlier date
+    def aggregate(first_day, last_day, as_of_day):
+        return aggregate_logs([model], is_batting, first_day, last_day, as_of_day, chunk_rows,
+                              get_cols([model], is_batting))[model["name"]]
+
+    return projection_state.load_sums(
+        model["name"], "batting" if is_batting else "pitching", settings,
+        projection_day, MAX_DAYS_AGO, model["get_rates"](settings, is_batting), aggregate,
+    )
+
+
+def indexed_sums(model, settings, is_batting, first_day, last_day, projection_day, players=None, cols=None):
+
+    # The same sums as weight_logs, from decay_index. Its columns are the weighted
+    # columns, then each league average role's stats and row count (undecayed).
+    rates = model["get_rates"](settings, is_batting)
+    lg_cols = model["league_cols"](settings, is_batting)
+    roles = (["all"] if is_batting else ["sp", "rp"]) if lg_cols else []
+    lg_rates = pd.Series(1.0, ["{}:{}".format(role, col) for role in roles for col in lg_cols + ["rows"]], dtype=float)
+
+    def row_values(df):
+        prepare_logs(df, is_batting, None)
+        values = [model["weight_rows"](df, settings, is_batting)[rates.index]]
+        if lg_cols:
+            for role, mask in league_masks(df, is_batting).items():
+                role_values = df[lg_cols].assign(rows=1).to_numpy() * mask.to_numpy()[:, None]
+                role_values = pd.DataFrame(role_values, index=df.index, columns=lg_cols + ["rows"])
+                values.append(role_values.add_prefix(role + ":"))
+        return pd.concat(values, axis=1)
+
+    sums = decay_index.load_sums(
+        model["name"], is_batting, settings, pd.concat([rates, lg_rates]), row_values, cols,
+        first_day, last_day, projection_day, players,
+    )
+
+    pr = sums[rates.index]
+    lg_sums = {}
+    for role in roles:
+        role_sums = sums[sums["{}:rows".format(role)] > 0]
+        lg_sums[role] = role_sums[["{}:{}".format(role, col) for col in lg_cols]].set_axis(lg_cols, axis=1)
+
+    return pr, lg_sums
+
+
+def league_masks(df, is_batting):
+
+    # The MLB regular season rows behind each league average
+    lg_mask = (df["league_id"] == MLB) & (df["game_type"] == REGULAR_SEASON)
+    if is_batting:
+        return {"all": lg_mask}
+    return {"sp": lg_mask & (df["GS"] == 1), "rp": lg_mask & (df["GS"] == 0)}
+
+
+def add_sums(total, sums):
+
+    # Running per-player totals; players missing from either side count as zeros
+    if total is None:
+        return sums
+    return total.add(sums, fill_value=0)
+
+
+if __name__ == "__main__":
+    main()
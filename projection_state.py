@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import pandas as pd
+
+import build_logs
+import gamelog_snapshot
+
+# Saved per-player sums of a model's decayed stats, so a daily run can start from
+# yesterday's instead of re-weighting the whole projection window. Every decayed sum
+# is sum(stat * rate ** days_ago), so moving the projection date forward k days is:
+#   (sums - rows aging out of the window) * rate ** k + rows newly in the window
+# Unweighted sums (the league average inputs) have a rate of 1.
+STATE_DIR = Path(__file__).parent / "state"
+
+# Saved states kept per model and table, most recently written first. A few are
+# kept so a run for another date (like opening day in the preseason) doesn't throw
+# away the one the daily run advances.
+STATE_KEEP = 3
+
+# A state is rebuilt from scratch after this many advances, so rounding can't build up
+MAX_ADVANCES = 60
+
+
+def load_sums(name, table, settings, projection_day, max_days_ago, rates, aggregate,
+              db_path=build_logs.DB_PATH, snapshot_dir=None, state_dir=None):
+
+    # The sums for projection_day, as (pr, lg_sums) like aggregate returns them.
+    # aggregate(first_day, last_day, projection_day) sums the game logs from first_day
+    # to last_day, decayed as of projection_day; rates are the decay rate of each pr column.
+    state_dir = Path(state_dir or STATE_DIR)
+    snapshot_dir = Path(snapshot_dir or gamelog_snapshot.SNAPSHOT_DIR)
+    gamelog_snapshot.update_snapshot(db_path, snapshot_dir)
+    meta = gamelog_snapshot.read_meta(snapshot_dir / table)
+
+    fingerprint = get_fingerprint(settings, max_days_ago)
+    state = find_state(state_dir, name, table, projection_day, fingerprint)
+    if state is not None and not state_changed(state, max_days_ago, db_path):
+        days = projection_day - state["day"]
+        if days == 0:
+            return state["pr"], state["lg_sums"]
+        if days <= max_days_ago and state["advances"] < MAX_ADVANCES:
+            state = advance_state(state, days, max_days_ago, rates, aggregate)
+        else:
+            state = None
+
+    if state is None:
+        pr, lg_sums = aggregate(projection_day - max_days_ago, projection_day - 1, projection_day)
+        state = {"day": projection_day, "advances": 0, "pr": pr, "lg_sums": lg_sums}
+
+    state.update(fingerprint=fingerprint, fetched_at=meta["fetched_at"], fetched_games=meta["fetched_games"])
+    save_state(state_dir, name, table, state)
+
+    return state["pr"], state["lg_sums"]
+
+
+def advance_state(state, days, max_days_ago, rates, aggregate):
+
+    old_day = state["day"]
+    new_day = old_day + days
+
+    # Rows leaving the window are taken out at their old weight, before decaying
+    # everything, and rows entering it are added at their new one
+    removed_pr, removed_lg_sums = aggregate(old_day - max_days_ago, new_day - max_days_ago - 1, old_day)
+    added_pr, added_lg_sums = aggregate(old_day, new_day - 1, new_day)
+
+    pr = state["pr"].sub(removed_pr, fill_value=0)
+    pr = pr.mul(rates[pr.columns] ** days).add(added_pr, fill_value=0)
+
+    lg_sums = {}
+    for role, sums in state["lg_sums"].items():
+        sums = sums.sub(removed_lg_sums[role], fill_value=0).add(added_lg_sums[role], fill_value=0)
+        lg_sums[role] = drop_empty(sums)
+
+    return {"day": new_day, "advances": state["advances"] + 1, "pr": drop_empty(pr), "lg_sums": lg_sums}
+
+
+def drop_empty(sums):
+
+    # Rows aged out of the window leave rounding error (like a GS of 1e-16) where a full
+    # scan has exact zeros, which matter to tests like a pitcher having no starts.
+    # Players with every row aged out are left with nothing.
+    sums = sums.mask(sums.abs() < 1e-9, 0.0)
+    return sums[(sums != 0).any(axis=1)]
+
+
+def state_changed(state, max_days_ago, db_path):
+
+    # Games fetched after the state was saved are fine if they're from its day on,
+    # since they're added as the day moves past them. Games in its window aren't.
+    con = build_logs.connect_db(db_path)
+    try:
+        changed = gamelog_snapshot.get_changed_games(con, state["fetched_at"], state["fetched_games"])
+    finally:
+        con.close()
+
+    first_day = state["day"] - max_days_ago
+    return any(first_day <= build_logs.date_to_day(game[1]) < state["day"] for game in changed)
+
+
+def get_fingerprint(settings, max_days_ago):
+
+    # Saved sums only apply to the settings they were weighted with
+    settings = json.dumps([settings, max_days_ago], sort_keys=True)
+    return hashlib.sha1(settings.encode()).hexdigest()
+
+
+def find_state(state_dir, name, table, projection_day, fingerprint):
+
+    # The latest saved state on or before the projection date
+    states = sorted(
+        (day, path) for day, path in state_paths(state_dir, name, table).items() if day <= projection_day
+    )
+    for day, path in reversed(states):
+        state = pd.read_pickle(path)
+        if state["fingerprint"] == fingerprint:
+            return state
+
+    return None
+
+
+def save_state(state_dir, name, table, state):
+
+    state_dir.mkdir(parents=True, exist_ok=True)
+    path = state_dir / "{}_{}_{}.pkl".format(name, table, state["day"])
+    tmp_path = path.with_name("{}.{}.tmp".format(path.name, os.getpid()))
+    pd.to_pickle(state, tmp_path)
+    os.replace(tmp_path, path)
+
+    # Only the most recently written few are kept
+    paths = sorted(state_paths(state_dir, name, table).values(), key=lambda path: path.stat().st_mtime)
+    for path in paths[:-STATE_KEEP]:
+        path.unlink(missing_ok=True)
+
+
+def state_paths(state_dir, name, table):
+
+    paths = {}
+    for path in state_dir.glob("{}_{}_*.pkl".format(name, table)):
+        day = path.stem.rsplit("_", 1)[1]
+        if day.isdigit():
+            paths[int(day)] = path
+
+    return paths
@@ -0,0 +1,122 @@
+import asyncio
+import contextvars
+import email.utils
+import random
+import time
+
+import requests
+
+# Statuses worth asking again for; anything else is a real error
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class RequestController:
+
+    # Runs blocking request functions on an executor, retrying transient failures
+    # with jittered exponential backoff. How many requests can be in flight grows
+    # by one per round of fast successes and halves on errors or slow responses (AIMD).
+
+    def __init__(self, executor, max_concurrency, min_concurrency=1, retries=5,
+                 base_delay=0.5, max_delay=60.0, target_latency=2.0):
+        self.executor = executor
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.target_latency = target_latency
+
+        self.limit = float(max(min_concurrency, max_concurrency // 2))
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.retry_count = 0
+        self.condition = asyncio.Condition()
+
+    async def run(self, func, *args):
+
+        loop = asyncio.get_running_loop()
+
+        # The executor threads see the same context variables as the caller
+        context = contextvars.copy_context()
+
+        for attempt in range(self.retries + 1):
+            await self.acquire()
+            start = time.monotonic()
+            try:
+                result = await loop.run_in_executor(self.executor, context.run, func, *args)
+            except Exception as error:
+                await self.release()
+                if attempt == self.retries or not is_retryable(error):
+                    raise
+
+                self.decrease()
+                self.retry_count += 1
+                await asyncio.sleep(self.backoff(attempt, error))
+                continue
+
+            await self.release()
+            latency = time.monotonic() - start
+            if latency > self.target_latency:
+                self.decrease()
+            else:
+                self.increase()
+
+            return result
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def increase(self):
+        self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+    def decrease(self):
+
+        # A burst of failures from the same moment only counts once
+        now = time.monotonic()
+        if now - self.last_decrease > self.target_latency:
+            self.limit = max(self.min_concurrency, self.limit / 2)
+            self.last_decrease = now
+
+    def backoff(self, attempt, error):
+
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+        # The server knows best how long to wait
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, min(self.max_delay, retry_after))
+
+        return delay
+
+
+def is_retryable(error):
+
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code in RETRY_STATUSES
+
+    return False
+
+
+def get_retry_after(error):
+
+    response = getattr(error, "response", None)
+    if response is None or "Retry-After" not in response.headers:
+        return None
+
+    # Either a number of seconds or an HTTP date
+    value = response.headers["Retry-After"]
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
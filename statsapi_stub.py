@@ -0,0 +1,234 @@
+import argparse
+import datetime
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import build_logs
+
+# Stand-in for the parts of statsapi.mlb.com that build_logs uses.
+# Fixtures are laid out as:
+#   <fixture_dir>/schedule/<sportId>.json  - {"dates": [...]} for every recorded date
+#   <fixture_dir>/boxscore/<gamePk>.json   - the raw boxscore response
+
+FIXTURE_DIR = Path(__file__).parent / "fixtures" / "statsapi"
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Replay recorded Stats API responses")
+    parser.add_argument("--fixtures", default=str(FIXTURE_DIR))
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.02, help="random extra seconds, up to this much")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with a 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of requests answered with a 429")
+    parser.add_argument("--record", nargs=2, metavar=("START_DATE", "END_DATE"),
+                        help="record fixtures from the real API instead of serving")
+    parser.add_argument("--synthesize", nargs=2, metavar=("START_DATE", "END_DATE"),
+                        help="generate fake fixtures instead of serving")
+    args = parser.parse_args()
+
+    if args.record:
+        record_fixtures(args.record[0], args.record[1], Path(args.fixtures))
+    elif args.synthesize:
+        synthesize_fixtures(args.synthesize[0], args.synthesize[1], Path(args.fixtures))
+    else:
+        server = serve(Path(args.fixtures), args.port, args.latency, args.jitter, args.error_rate, args.throttle_rate)
+        print("Serving {} on {}".format(args.fixtures, server.url))
+        try:
+            server.thread.join()
+        except KeyboardInterrupt:
+            server.shutdown()
+
+
+def serve(fixture_dir=FIXTURE_DIR, port=0, latency=0.05, jitter=0.02, error_rate=0.0, throttle_rate=0.0):
+
+    fixtures = load_fixtures(fixture_dir)
+
+    class Handler(StubHandler):
+        pass
+
+    Handler.fixtures = fixtures
+    Handler.latency = latency
+    Handler.jitter = jitter
+    Handler.error_rate = error_rate
+    Handler.throttle_rate = throttle_rate
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    server.url = "http://127.0.0.1:{}/api/v1".format(server.server_address[1])
+    server.thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server.thread.start()
+
+    return server
+
+
+def load_fixtures(fixture_dir):
+
+    fixtures = {"schedule": {}, "boxscore": {}}
+
+    for path in (fixture_dir / "schedule").glob("*.json"):
+        schedule = json.loads(path.read_bytes())
+        fixtures["schedule"][int(path.stem)] = {date["date"]: date for date in schedule["dates"]}
+
+    # Boxscores are served straight from disk, so only their paths are kept
+    for path in (fixture_dir / "boxscore").glob("*.json"):
+        fixtures["boxscore"][int(path.stem)] = path
+
+    return fixtures
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    fixtures = {"schedule": {}, "boxscore": {}}
+    latency = 0.0
+    jitter = 0.0
+    error_rate = 0.0
+    throttle_rate = 0.0
+
+    def do_GET(self):
+
+        time.sleep(self.latency + random.random() * self.jitter)
+
+        roll = random.random()
+        if roll < self.error_rate:
+            return self.send_json(503, {"message": "Injected error"})
+        if roll < self.error_rate + self.throttle_rate:
+            return self.send_json(429, {"message": "Injected throttle"}, {"Retry-After": "1"})
+
+        url = urlparse(self.path)
+        match = re.search(r"/game/(\d+)/boxscore$", url.path)
+        if match:
+            path = self.fixtures["boxscore"].get(int(match.group(1)))
+            if path is None:
+                return self.send_json(404, {"message": "Unknown game"})
+            return self.send_body(200, path.read_bytes())
+
+        if url.path.rstrip("/").endswith("/schedule"):
+            return self.send_json(200, self.get_schedule(parse_qs(url.query)))
+
+        self.send_json(404, {"message": "Unknown endpoint"})
+
+    def get_schedule(self, query):
+
+        if "date" in query:
+            start_date = end_date = query["date"][0]
+        else:
+            start_date = query["startDate"][0]
+            end_date = query["endDate"][0]
+
+        dates = []
+        for sportId in query["sportId"][0].split(","):
+            recorded = self.fixtures["schedule"].get(int(sportId), {})
+            dates += [recorded[d] for d in sorted(recorded) if start_date <= d <= end_date]
+
+        return {"totalGames": sum(len(date["games"]) for date in dates), "dates": dates}
+
+    def send_json(self, status, data, headers=None):
+        self.send_body(status, json.dumps(data).encode(), headers)
+
+    def send_body(self, status, body, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def record_fixtures(start_date, end_date, fixture_dir=FIXTURE_DIR):
+
+    # Pull real responses for a date span so they can be replayed later
+    session = build_logs.new_session()
+    date_strings = get_dates(start_date, end_date)
+
+    for sportId in build_logs.SPORT_IDS:
+        dates = []
+        for range_start, range_end in build_logs.get_date_ranges(date_strings):
+            url = "{}/schedule/?sportId={}&startDate={}&endDate={}".format(build_logs.API_URL, sportId, range_start, range_end)
+            dates += session.get(url).json()["dates"]
+        save_fixture(fixture_dir / "schedule" / "{}.json".format(sportId), {"dates": dates})
+
+        for date in dates:
+            for game_data in date["games"]:
+                if game_data["status"]["codedGameState"] == "F":
+                    url = "{}/game/{}/boxscore".format(build_logs.API_URL, game_data["gamePk"])
+                    save_fixture(fixture_dir / "boxscore" / "{}.json".format(game_data["gamePk"]), session.get(url).json())
+
+
+def synthesize_fixtures(start_date, end_date, fixture_dir=FIXTURE_DIR, games_per_day=6, seed=0):
+
+    # Fake but well-formed responses, for benchmarking without recording anything
+    rnd = random.Random(seed)
+    batting_fields = [
+        "atBats", "runs", "hits", "doubles", "triples", "homeRuns", "rbi", "stolenBases", "caughtStealing",
+        "baseOnBalls", "strikeOuts", "intentionalWalks", "hitByPitch", "sacBunts", "sacFlies", "groundIntoDoublePlay",
+    ]
+    pitching_fields = [
+        "wins", "losses", "gamesPlayed", "gamesStarted", "completeGames", "shutouts", "saves", "holds",
+        "battersFaced", "hits", "earnedRuns", "runs", "homeRuns", "strikeOuts", "baseOnBalls",
+        "intentionalWalks", "hitByPitch", "wildPitches", "balks",
+    ]
+    game_pk = 100000
+
+    for sportId in build_logs.SPORT_IDS:
+        dates = []
+        for date_string in get_dates(start_date, end_date):
+            games = []
+            for _ in range(games_per_day):
+                game_pk += 1
+                games.append({
+                    "gamePk": game_pk,
+                    "gameType": "R",
+                    "venue": {"id": rnd.randint(1, 30)},
+                    "status": {"codedGameState": "F"},
+                })
+
+                teams = {}
+                for side in ["away", "home"]:
+                    players = {}
+                    for slot in range(14):
+                        player_id = 400000 + sportId * 1000 + rnd.randint(0, 999)
+                        batting = {field: rnd.randint(0, 2) for field in batting_fields} if slot < 9 else {}
+                        pitching = {}
+                        if slot >= 9:
+                            pitching = {field: str(rnd.randint(0, 2)) for field in pitching_fields}
+                            pitching["gamesStarted"] = "1" if slot == 9 else "0"
+                            pitching["inningsPitched"] = "{}.{}".format(rnd.randint(0, 7), rnd.randint(0, 2))
+                        player = {"person": {"id": player_id}, "stats": {"batting": batting, "pitching": pitching}}
+                        if slot < 9:
+                            player["battingOrder"] = str((slot + 1) * 100)
+                        players["ID{}".format(player_id)] = player
+                    teams[side] = {"players": players}
+
+                save_fixture(fixture_dir / "boxscore" / "{}.json".format(game_pk), {"teams": teams})
+
+            dates.append({"date": date_string, "games": games})
+
+        save_fixture(fixture_dir / "schedule" / "{}.json".format(sportId), {"dates": dates})
+
+
+def save_fixture(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(data))
+
+
+def get_dates(start_date, end_date):
+
+    start = datetime.date.fromisoformat(start_date)
+    end = datetime.date.fromisoformat(end_date)
+    return [(start + datetime.timedelta(days=i)).isoformat() for i in range((end - start).days + 1)]
+
+
+if __name__ == "__main__":
+    main()
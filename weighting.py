@@ -0,0 +1,62 @@
+import numpy as np
+
+import build_logs
+
+# The settings holding each minor league's factors, by MLB "SportID"
+LEAGUE_FACTORS = {
+    11: "aaa_factors",
+    12: "aa_factors",
+    13: "high_a_factors",
+    14: "low_a_factors",
+    16: "rookie_factors",
+    17: "fall_factors",
+}
+
+# Spring training and exhibition games are reduced, for every stat and its denominator
+GAME_TYPE_FACTORS = {
+    build_logs.GAME_TYPE_CODES["S"]: 0.45,
+    build_logs.GAME_TYPE_CODES["E"]: 0.45,
+}
+
+
+def compile_weights(settings, stats, max_days_ago):
+
+    # Turn a model's settings into lookup tables, so weighting a block of game logs
+    # is a few gathers and one multiply instead of a pass per stat and league:
+    #   decay[days_ago, stat]       - decay_rates[stat] ** days_ago
+    #   game_type[game_type]        - spring training/exhibition factor (unknown types, -1, are the last entry)
+    #   league[league_id, stat]     - minor league factor (1 for MLB, and for leagues outside
+    #                                 SPORT_IDS, which all use the last entry)
+    days = np.arange(max_days_ago + 1)
+    decay = np.column_stack([settings["decay_rates"][stat] ** days for stat in stats])
+
+    game_type = np.ones(len(build_logs.GAME_TYPE_CODES) + 1)
+    for code, factor in GAME_TYPE_FACTORS.items():
+        game_type[code] = factor
+
+    league = np.ones((max(build_logs.SPORT_IDS) + 2, len(stats)))
+    for league_id, factors in LEAGUE_FACTORS.items():
+        league[league_id] = [settings[factors][stat] for stat in stats]
+
+    return {"stats": stats, "decay": decay, "game_type": game_type, "league": league}
+
+
+def weight_stats(weights, df, denominator=None):
+
+    # The weighted stats for the game logs in df as one (rows, stats) block. With a
+    # denominator column, it's followed by that column weighted for each stat, which
+    # gets the decay and game type factors but not the league factors.
+    n = len(weights["stats"])
+    weighted = np.empty((len(df), 2 * n if denominator else n))
+    denom_weights = weighted[:, n:] if denominator else np.empty((len(df), n))
+
+    np.take(weights["decay"], df["days_ago"].to_numpy(), axis=0, out=denom_weights)
+    denom_weights *= weights["game_type"][df["game_type"].to_numpy()][:, None]
+    league_ids = df["league_id"].to_numpy().clip(-1, len(weights["league"]) - 1)
+    np.multiply(denom_weights, weights["league"][league_ids], out=weighted[:, :n])
+    weighted[:, :n] *= df[weights["stats"]].to_numpy()
+
+    if denominator:
+        denom_weights *= df[[denominator]].to_numpy()
+
+    return weighted